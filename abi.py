@@ -0,0 +1,113 @@
+from datetime import datetime, timezone
+import struct
+
+from eosapi.packer import Name, VarUint32
+
+
+FORMATS = {
+    "int8": "<b",
+    "uint8": "<B",
+    "int16": "<h",
+    "uint16": "<H",
+    "int32": "<i",
+    "uint32": "<I",
+    "int64": "<q",
+    "uint64": "<Q",
+    "float32": "<f",
+    "float64": "<d"
+}
+
+def pack_bool(value):
+    return b"\x01" if value else b"\x00"
+
+def pack_varint32(value):
+    value = int(value)
+    return VarUint32.pack(((value << 1) ^ (value >> 31)) & 0xFFFFFFFF)
+
+def pack_string(value):
+    value = value.encode()
+    return VarUint32.pack(len(value)) + value
+
+def pack_bytes(value):
+    value = bytes.fromhex(value)
+    return VarUint32.pack(len(value)) + value
+
+def pack_symbol_code(value):
+    if len(value) > 7:
+        raise ValueError(f"invalid symbol code {value}")
+    return value.encode().ljust(8, b"\x00")
+
+def pack_symbol(value):
+    precision, code = value.split(",")
+    return struct.pack("<B", int(precision)) + pack_symbol_code(code)[:7]
+
+def pack_asset(value):
+    amount, code = value.split()
+    precision = len(amount.split(".")[1]) if "." in amount else 0
+    return struct.pack("<q", int(amount.replace(".", ""))) + pack_symbol(f"{precision},{code}")
+
+def pack_extended_asset(value):
+    return pack_asset(value["quantity"]) + Name.pack(value["contract"])
+
+def pack_checksum(value):
+    return bytes.fromhex(value)
+
+def pack_time_point_sec(value):
+    moment = datetime.fromisoformat(value.rstrip("Z")).replace(tzinfo=timezone.utc)
+    return struct.pack("<I", int(moment.timestamp()))
+
+PACKERS = {
+    "bool": pack_bool,
+    "varuint32": lambda value: VarUint32.pack(int(value)),
+    "varint32": pack_varint32,
+    "name": Name.pack,
+    "string": pack_string,
+    "bytes": pack_bytes,
+    "symbol_code": pack_symbol_code,
+    "symbol": pack_symbol,
+    "asset": pack_asset,
+    "extended_asset": pack_extended_asset,
+    "checksum160": pack_checksum,
+    "checksum256": pack_checksum,
+    "checksum512": pack_checksum,
+    "time_point_sec": pack_time_point_sec
+}
+for name, fmt in FORMATS.items():
+    PACKERS[name] = lambda value, fmt=fmt: struct.pack(fmt, int(value) if fmt[-1] not in "fd" else float(value))
+
+class Abi:
+    def __init__(self, abi):
+        self.types = {item["new_type_name"]: item["type"] for item in abi.get("types", [])}
+        self.structs = {item["name"]: item for item in abi.get("structs", [])}
+        self.variants = {item["name"]: item["types"] for item in abi.get("variants", [])}
+        self.actions = {item["name"]: item["type"] for item in abi.get("actions", [])}
+
+    def pack_action(self, name, data):
+        return self.pack(self.actions[name], data)
+
+    def pack(self, type, value):
+        if type.endswith("$"):
+            if value is None:
+                return b""
+            type = type[:-1]
+        if type.endswith("?"):
+            if value is None:
+                return b"\x00"
+            return b"\x01" + self.pack(type[:-1], value)
+        if type.endswith("[]"):
+            return VarUint32.pack(len(value)) + b"".join(self.pack(type[:-2], item) for item in value)
+        if type in self.types:
+            return self.pack(self.types[type], value)
+        if type in PACKERS:
+            return PACKERS[type](value)
+        if type in self.variants:
+            return VarUint32.pack(self.variants[type].index(value[0])) + self.pack(value[0], value[1])
+        if type in self.structs:
+            fields = self.structs[type]
+            output = b""
+            if fields.get("base"):
+                output += self.pack(fields["base"], value)
+            for field in fields["fields"]:
+                output += self.pack(field["type"], value.get(field["name"]))
+            return output
+        raise ValueError(f"unsupported abi type {type}")
@@ -0,0 +1,480 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from datetime import datetime
+from time import sleep, time
+import bisect
+import gzip
+import hashlib
+import json
+import threading
+
+from eosapi.packer import Name
+
+
+BASE = 1099511627776
+COLLECTION = "benchcol"
+CUSTODIAL = "stake.bench"
+TOKEN = "bench.token"
+TICKETS = [200001, 200002, 200003]
+STALE_TEMPLATE = 999999
+TIME = 1600000000000
+CHAIN_ID = "aa" * 32
+BLOCK_ID = "0000000a" + "11" * 28
+NAME_CHARS = "abcdefghijklmnopqrstuvwxyz12345"
+TOKEN_ABI = {
+    "structs": [{"name": "transfer", "base": "", "fields": [
+        {"name": "from", "type": "name"},
+        {"name": "to", "type": "name"},
+        {"name": "quantity", "type": "asset"},
+        {"name": "memo", "type": "string"}
+    ]}],
+    "actions": [{"name": "transfer", "type": "transfer"}]
+}
+ATOMIC_ABI = {
+    "types": [{"new_type_name": "ATTRIBUTE_MAP", "type": "pair_string_ATOMIC_ATTRIBUTE[]"}],
+    "variants": [{"name": "ATOMIC_ATTRIBUTE", "types": [
+        "int8", "int16", "int32", "int64", "uint8", "uint16", "uint32", "uint64", "float32", "float64", "string"
+    ]}],
+    "structs": [
+        {"name": "pair_string_ATOMIC_ATTRIBUTE", "base": "", "fields": [
+            {"name": "key", "type": "string"},
+            {"name": "value", "type": "ATOMIC_ATTRIBUTE"}
+        ]},
+        {"name": "mintasset", "base": "", "fields": [
+            {"name": "authorized_minter", "type": "name"},
+            {"name": "collection_name", "type": "name"},
+            {"name": "schema_name", "type": "name"},
+            {"name": "template_id", "type": "int32"},
+            {"name": "new_asset_owner", "type": "name"},
+            {"name": "immutable_data", "type": "ATTRIBUTE_MAP"},
+            {"name": "mutable_data", "type": "ATTRIBUTE_MAP"},
+            {"name": "tokens_to_back", "type": "asset[]"}
+        ]},
+        {"name": "setassetdata", "base": "", "fields": [
+            {"name": "authorized_editor", "type": "name"},
+            {"name": "asset_owner", "type": "name"},
+            {"name": "asset_id", "type": "uint64"},
+            {"name": "new_mutable_data", "type": "ATTRIBUTE_MAP"}
+        ]}
+    ],
+    "actions": [
+        {"name": "mintasset", "type": "mintasset"},
+        {"name": "setassetdata", "type": "setassetdata"}
+    ]
+}
+
+def wallet(index):
+    name = ""
+    while True:
+        name += NAME_CHARS[index % len(NAME_CHARS)]
+        index //= len(NAME_CHARS)
+        if index == 0:
+            return "bw" + name
+
+class Data:
+    def __init__(self, assets, templates=None, wallets=None, latency=0, poison=None):
+        self.assets = assets
+        self.templates = templates or max(1, assets // 2000)
+        self.wallets = wallets or max(10, assets // 20)
+        self.latency = latency
+        self.poison = Name.pack(wallet(poison)) if poison is not None else None
+        self.lock = threading.Lock()
+        self.stored = {}
+        self.sorted = {}
+        self.stale_template = True
+        self.logs = 0
+        self.applied = set()
+        # Chain time floor, transactions signed before it count as expired
+        self.horizon = 0
+        self.stats = {}
+        self.seed()
+
+    def template_id(self, t):
+        # The first template doubles as pawsome's hard-coded template
+        return 730860 if t == 0 else 100000 + t
+
+    def template_index(self, template_id):
+        if template_id == 730860:
+            return 0
+        t = template_id - 100000
+        return t if 0 < t < self.templates else None
+
+    def seed(self):
+        # One stored row per template that no longer exists on chain, plus a removed template
+        for t in range(self.templates):
+            self.stored.setdefault(self.template_id(t), set()).add(BASE + self.assets + t)
+        self.stored[STALE_TEMPLATE] = {BASE + self.assets + self.templates}
+
+    def owner(self, k):
+        if k % 100 == 3:
+            return None
+        if k % 50 == 7:
+            return CUSTODIAL
+        return wallet(k % self.wallets)
+
+    def listed(self, k):
+        return k % 33 == 5 and self.owner(k) is not None
+
+    def asset(self, k):
+        t = k % self.templates
+        tid = str(self.template_id(t))
+        name = f"Bench {t}"
+        data = {"name": name, "img": "QmTemplateImage"}
+        issued = (self.assets - t + self.templates - 1) // self.templates
+        return {
+            "contract": "atomicassets",
+            "asset_id": str(BASE + k),
+            "owner": self.owner(k),
+            "is_transferable": True,
+            "is_burnable": True,
+            "collection": {
+                "collection_name": COLLECTION,
+                "name": "Bench Collection",
+                "img": "QmCollectionImage",
+                "author": "bench.author",
+                "allow_notify": True,
+                "authorized_accounts": ["bench.acc", "bench.author"],
+                "notify_accounts": [],
+                "market_fee": 0.05,
+                "data": {"name": "Bench Collection", "img": "QmCollectionImage", "description": "Synthetic collection " * 4},
+                "created_at_block": "1000",
+                "created_at_time": str(TIME)
+            },
+            "schema": {
+                "schema_name": "bench",
+                "format": [{"name": "name", "type": "string"}, {"name": "img", "type": "image"}],
+                "created_at_block": "1000",
+                "created_at_time": str(TIME)
+            },
+            "template": {
+                "template_id": tid,
+                "max_supply": "0",
+                "is_transferable": True,
+                "is_burnable": True,
+                "issued_supply": str(issued),
+                "immutable_data": data,
+                "created_at_time": str(TIME),
+                "created_at_block": "1000"
+            },
+            "mutable_data": {"img": "normal"},
+            "immutable_data": {},
+            "template_mint": str(k // self.templates + 1),
+            "backed_tokens": [],
+            "burned_by_account": None,
+            "burned_at_block": None,
+            "burned_at_time": None,
+            "updated_at_block": str(2000 + k),
+            "updated_at_time": str(TIME + k),
+            "transferred_at_block": str(2000 + k),
+            "transferred_at_time": str(TIME + k),
+            "minted_at_block": str(1500 + k),
+            "minted_at_time": str(TIME + k),
+            "data": data,
+            "name": name
+        }
+
+    def sale(self, k):
+        asset = self.asset(k)
+        return {
+            "market_contract": "atomicmarket",
+            "assets_contract": "atomicassets",
+            "sale_id": str(k + 1),
+            "seller": asset["owner"],
+            "buyer": None,
+            "offer_id": str(k + 1),
+            "price": {"token_contract": "eosio.token", "token_symbol": "WAX", "token_precision": 8, "median": None, "amount": "100000000"},
+            "listing_price": "100000000",
+            "listing_symbol": "WAX",
+            "assets": [asset],
+            "maker_marketplace": "",
+            "taker_marketplace": None,
+            "collection_name": COLLECTION,
+            "collection": asset["collection"],
+            "is_seller_contract": False,
+            "updated_at_block": str(2000 + k),
+            "updated_at_time": str(TIME + k),
+            "created_at_block": str(2000 + k),
+            "created_at_time": str(TIME + k),
+            "state": 1
+        }
+
+    def ids(self, template_id, lower_bound, limit):
+        t = self.template_index(template_id)
+        if t is None:
+            return []
+        start = max(0, lower_bound - BASE - t)
+        m = -(-start // self.templates)
+        output = []
+        k = t + m * self.templates
+        while k < self.assets and len(output) < limit:
+            output.append(k)
+            k += self.templates
+        return output
+
+    def stored_ids(self, template_id):
+        with self.lock:
+            if template_id not in self.sorted:
+                self.sorted[template_id] = sorted(self.stored.get(template_id, ()))
+            return self.sorted[template_id]
+
+    def upsert(self, rows):
+        with self.lock:
+            for row in rows:
+                self.stored.setdefault(row["template_id"], set()).add(row["asset_id"])
+                self.sorted.pop(row["template_id"], None)
+
+    def delete(self, column, values):
+        with self.lock:
+            values = set(values)
+            if column == "template_id":
+                for template_id in values:
+                    self.stored.pop(template_id, None)
+                    self.sorted.pop(template_id, None)
+                    if template_id == STALE_TEMPLATE:
+                        self.stale_template = False
+                return
+            for template_id, ids in self.stored.items():
+                if ids & values:
+                    ids -= values
+                    self.sorted.pop(template_id, None)
+
+    def count(self, kind, sent, received):
+        with self.lock:
+            item = self.stats.setdefault(kind, {"requests": 0, "bytes_in": 0, "bytes_out": 0})
+            item["requests"] += 1
+            item["bytes_in"] += received
+            item["bytes_out"] += sent
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def do_DELETE(self):
+        self.handle_request()
+
+    def handle_request(self):
+        data = self.server.data
+        parts = urlsplit(self.path)
+        path = "/" + "/".join(item for item in parts.path.split("/") if item)
+        query = {key: values[0] for key, values in parse_qs(parts.query).items()}
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        received = len(body) + len(self.path)
+        if self.headers.get("Content-Encoding") == "gzip":
+            body = gzip.decompress(body)
+
+        if path.startswith("/__"):
+            code, payload = self.control(path)
+            kind = None
+        else:
+            if data.latency > 0:
+                sleep(data.latency)
+            kind, code, payload = self.route(path, query, body)
+
+        output = b"" if payload is None else json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(output)))
+        self.end_headers()
+        self.wfile.write(output)
+        if kind is not None:
+            data.count(kind, len(output), received)
+
+    def control(self, path):
+        data = self.server.data
+        if path == "/__stats":
+            with data.lock:
+                return 200, {"stats": data.stats, "logs": data.logs, "stored": sum(len(item) for item in data.stored.values())}
+        if path == "/__reset":
+            with data.lock:
+                data.stats = {}
+            return 200, {}
+        return 404, {}
+
+    def route(self, path, query, body):
+        if path.startswith("/atomicassets") or path.startswith("/atomicmarket"):
+            return ("aa",) + self.indexer(path, query)
+        if path.startswith("/v1/chain") or path.startswith("/v1/history"):
+            return ("chain",) + self.chain(path, body)
+        if path.startswith("/webhook"):
+            return "webhook", 204, None
+        if "/rest/v1/" in path:
+            return ("rest",) + self.rest(path, query, body)
+        return "other", 404, {"message": "unknown route"}
+
+    def indexer(self, path, query):
+        data = self.server.data
+        limit = min(int(query.get("limit", 100)), 1000)
+        page = int(query.get("page", 1))
+        if path == "/atomicassets/v1/assets":
+            if "ids" in query:
+                ks = [int(item) - BASE for item in query["ids"].split(",")]
+                ks = [k for k in ks if 0 <= k < data.assets]
+            else:
+                ks = data.ids(int(query.get("template_id", 0)), int(query.get("lower_bound") or 0), limit)
+            return 200, {"success": True, "data": [data.asset(k) for k in ks[:limit]]}
+        if path == "/atomicassets/v1/transfers":
+            ks = [int(item) - BASE for item in query.get("asset_id", "").split(",") if item]
+            after = int(query.get("after", 0))
+            transfers = []
+            for k in ks:
+                if 0 <= k < data.assets and data.owner(k) == CUSTODIAL and TIME + k > after:
+                    transfers.append({
+                        "transfer_id": str(k),
+                        "sender_name": wallet(k % data.wallets),
+                        "recipient_name": CUSTODIAL,
+                        "memo": "stake",
+                        "assets": [data.asset(k)],
+                        "created_at_block": str(2000 + k),
+                        "created_at_time": str(TIME + k)
+                    })
+            transfers.sort(key=lambda item: -int(item["created_at_time"]))
+            return 200, {"success": True, "data": transfers[(page - 1) * limit:page * limit]}
+        if path == "/atomicmarket/v1/sales":
+            if "asset_id" in query:
+                ks = [int(item) - BASE for item in query["asset_id"].split(",")]
+                ks = [k for k in ks if 0 <= k < data.assets and data.listed(k)]
+                return 200, {"success": True, "data": [data.sale(k) for k in ks][(page - 1) * limit:page * limit]}
+            if query.get("sort") == "updated":
+                start = data.assets - 1 - (page - 1) * limit * 33
+                ks = [k for k in range(start, max(-1, start - limit * 33), -1) if data.listed(k)]
+                return 200, {"success": True, "data": [data.sale(k) for k in ks[:limit]]}
+            k = max(0, int(query.get("lower_bound") or 0) - 1)
+            output = []
+            while k < data.assets and len(output) < limit:
+                if data.listed(k):
+                    output.append(data.sale(k))
+                k += 1
+            return 200, {"success": True, "data": output}
+        return 404, {"success": False, "message": "unknown route"}
+
+    def chain(self, path, body):
+        data = self.server.data
+        if path == "/v1/chain/get_info":
+            now = datetime.utcfromtimestamp(max(time(), data.horizon)).isoformat(timespec="milliseconds")
+            return 200, {
+                "chain_id": CHAIN_ID, "head_block_num": 10, "last_irreversible_block_num": 10, "last_irreversible_block_id": BLOCK_ID,
+                "head_block_time": now, "last_irreversible_block_time": now
+            }
+        if path == "/v1/chain/get_abi":
+            account = json.loads(body)["account_name"]
+            return 200, {"account_name": account, "abi": TOKEN_ABI if account == TOKEN else ATOMIC_ABI}
+        if path == "/v1/chain/get_consensus_parameters":
+            return 200, {"chain_config": {"max_transaction_cpu_usage": 150000, "max_transaction_net_usage": 524288}}
+        if path == "/v1/chain/abi_json_to_bin":
+            return 200, {"binargs": "00"}
+        if path == "/v1/chain/push_transaction":
+            packed = bytes.fromhex(json.loads(body)["packed_trx"])
+            if data.poison is not None and data.poison in packed:
+                return 500, {"code": 500, "message": "Internal Service Error", "error": {
+                    "code": 3050003, "name": "eosio_assert_message_exception", "what": "eosio_assert_message assertion failure",
+                    "details": [{"message": "assertion failure with message: poisoned recipient", "file": "", "line_number": 0, "method": ""}]
+                }}
+            txn_id = hashlib.sha256(packed).hexdigest()
+            if int.from_bytes(packed[:4], "little") < max(time(), data.horizon):
+                return 500, {"code": 500, "message": "Internal Service Error", "error": {
+                    "code": 3040005, "name": "expired_tx_exception", "what": "Expired Transaction",
+                    "details": [{"message": "expired transaction", "file": "", "line_number": 0, "method": ""}]
+                }}
+            # Header is 13 bytes, then the empty context free action list and the action count
+            actions = packed[14]
+            with data.lock:
+                known = txn_id in data.applied
+                if not known:
+                    data.applied.add(txn_id)
+                    data.logs += actions
+            if known:
+                return 500, {"code": 500, "message": "Internal Service Error", "error": {
+                    "code": 3040008, "name": "tx_duplicate", "what": "Duplicate transaction",
+                    "details": [{"message": f"duplicate transaction {txn_id}", "file": "", "line_number": 0, "method": ""}]
+                }}
+            return 200, {"transaction_id": txn_id, "processed": {"receipt": {
+                "status": "executed", "cpu_usage_us": 150 + 120 * actions, "net_usage_words": len(packed) // 8 + 12
+            }}}
+        if path == "/v1/history/get_transaction":
+            txn_id = json.loads(body)["id"]
+            with data.lock:
+                known = txn_id in data.applied
+            if known:
+                return 200, {"id": txn_id, "trx": {"receipt": {"status": "executed"}}}
+            return 500, {"code": 500, "message": "Internal Service Error", "error": {
+                "code": 3040011, "name": "tx_not_found", "what": "The transaction can not be found",
+                "details": [{"message": f"Transaction {txn_id} not found in history", "file": "", "line_number": 0, "method": ""}]
+            }}
+        return 404, {"code": 404, "message": "unknown route"}
+
+    def rest(self, path, query, body):
+        data = self.server.data
+        secondary = path.startswith("/two")
+        resource = path.split("/v1/", 1)[1]
+        method = self.command
+        if resource.startswith("rpc/"):
+            params = json.loads(body or b"{}")
+            lim, off = params.get("lim", 1000), params.get("off", 0)
+            name = resource[4:]
+            if name == "get_templates":
+                with data.lock:
+                    rows = [{"template_id": item} for item in sorted(data.stored)]
+                return 200, rows[off:off + lim]
+            if name == "get_wallets":
+                key = "address" if secondary else "wallet"
+                return 200, [{key: wallet(i)} for i in range(off, min(off + lim, data.wallets))]
+            if name == "get_drip":
+                return 200, 1.5
+            if name == "get_all_drip":
+                return 200, [{"wallet": wallet(i), "drip": 0 if i % 10 == 0 else round(1 + i % 7 * 0.25, 4)} for i in range(off, min(off + lim, data.wallets))]
+            return 404, {"message": "unknown rpc"}
+        if resource == "drip_template_data":
+            return 200, [{
+                "collection": COLLECTION,
+                "template_id": data.template_id(t),
+                "drip_amount": 1.5,
+                "ownership": t % 4 == 1,
+                "mint_bonuses": {"1": 5, "2": 3},
+                "throttle": t % 2 == 0
+            } for t in range(data.templates)]
+        if resource == "drip_config":
+            if method == "POST":
+                return 201, None
+            return 200, [{"config": "throttle", "value": "0.9"}, {"config": "vip_only", "value": "false"}]
+        if resource == "blocklist_main":
+            return 200, [{"collection": wallet(i)} for i in range(1, data.wallets, 97)]
+        if resource == "sale_warning_data":
+            return 200, [{
+                "collection": COLLECTION,
+                "template_id": data.template_id(t),
+                "normal": "normal",
+                "warning": "warning"
+            } for t in range(min(data.templates, 4))]
+        if resource in ("drip_log", "ticket_log", "pawsome"):
+            with data.lock:
+                data.logs += len(json.loads(body))
+            return 201, None
+        if resource == "drip_asset_data2":
+            if method == "POST":
+                data.upsert(json.loads(body))
+                return 201, None
+            if method == "DELETE":
+                for column in ("asset_id", "template_id"):
+                    if column in query:
+                        values = query[column][len("in.("):-1] if query[column].startswith("in.") else query[column][len("eq."):]
+                        data.delete(column, [int(item) for item in values.split(",")])
+                return 204, None
+            ids = data.stored_ids(int(query["template_id"][len("eq."):]))
+            start = bisect.bisect_right(ids, int(query.get("asset_id", "gt.0")[len("gt."):]))
+            return 200, [{"asset_id": item} for item in ids[start:start + min(int(query.get("limit", 1000)), 1000)]]
+        return 404, {"message": "unknown table"}
+
+def serve(data, port=0):
+    server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+    server.daemon_threads = True
+    server.data = data
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,121 @@
+#!/usr/bin/python3
+from time import perf_counter
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from fake import COLLECTION, CUSTODIAL, TICKETS, TOKEN, Data, serve
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOBS = ["nftv", "nftv2", "ticket", "sale_warn", "pawsome"]
+KEY = "5KQwrPbwdL6PhXujxW37FSSQZ1JiwsST4cqQzDeyXtP79zkvFD3"
+
+def write_config(path, url, args):
+    with open(os.path.join(ROOT, "config_templates", "config.json")) as file:
+        config = json.load(file)
+    config.update({
+        "supabase_key": "bench",
+        "supabase_url": f"{url}/rest/v1/",
+        "supabase2_key": "bench",
+        "supabase2_url": f"{url}/two/rest/v1/",
+        "acc": "bench.acc",
+        "acc_key": KEY,
+        "webhook": f"{url}/webhook",
+        "toptix_col": COLLECTION,
+        "toptix_schema": "tickets",
+        "toptix_tid": 100001,
+        "toptix_choices": [
+            {"template_id": TICKETS[0], "weight": 70, "name": "Bronze"},
+            {"template_id": TICKETS[1], "weight": 25, "name": "Silver"},
+            {"template_id": TICKETS[2], "weight": 5, "name": "Gold"}
+        ],
+        "token_sym": "BENCH",
+        "token_contract": TOKEN,
+        "token_precision": 4,
+        "custodial": [CUSTODIAL],
+        "aa": url,
+        "aa_key": "bench",
+        "rpc": url,
+        "rpc_key": "bench",
+        "logs": os.path.join(path, "logs")
+    })
+    config.update(json.loads(args.config))
+    with open(os.path.join(path, "config.json"), "w") as file:
+        json.dump(config, file, indent=4)
+    for name in ("skip.json", "skip2.json"):
+        with open(os.path.join(path, name), "w") as file:
+            json.dump([], file)
+    os.makedirs(os.path.join(path, "logs"), exist_ok=True)
+
+def run(job, path, server):
+    server.data.stats = {}
+    with open(os.path.join(path, f"{job}.out"), "w") as output:
+        start = perf_counter()
+        code = subprocess.run(
+            [sys.executable, os.path.join(ROOT, f"{job}.py")],
+            cwd=path,
+            stdout=output,
+            stderr=subprocess.STDOUT
+        ).returncode
+        elapsed = perf_counter() - start
+    with server.data.lock:
+        stats = dict(server.data.stats)
+    return {
+        "job": job,
+        "status": code,
+        "seconds": round(elapsed, 3),
+        "requests": {kind: item["requests"] for kind, item in stats.items()},
+        "bytes_in": sum(item["bytes_in"] for item in stats.values()),
+        "bytes_out": sum(item["bytes_out"] for item in stats.values())
+    }
+
+def show(results):
+    print(f"{'job':<10} {'exit':>4} {'seconds':>9} {'aa':>7} {'rest':>7} {'chain':>7} {'sent MB':>9} {'recv MB':>9}")
+    for item in results:
+        requests = item["requests"]
+        print(
+            f"{item['job']:<10} {item['status']:>4} {item['seconds']:>9.2f} "
+            f"{requests.get('aa', 0):>7} {requests.get('rest', 0):>7} {requests.get('chain', 0):>7} "
+            f"{item['bytes_in'] / 1e6:>9.2f} {item['bytes_out'] / 1e6:>9.2f}"
+        )
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the jobs end to end against local stand-in services")
+    parser.add_argument("--assets", type=int, default=10000, help="synthetic asset count, e.g. 10000, 100000 or 1000000")
+    parser.add_argument("--templates", type=int, default=None, help="template count, defaults to one per 2000 assets")
+    parser.add_argument("--wallets", type=int, default=None, help="wallet count, defaults to one per 20 assets")
+    parser.add_argument("--latency", type=float, default=0.02, help="seconds added to every stand-in response")
+    parser.add_argument("--poison", type=int, default=None, help="wallet index whose transfers the chain rejects")
+    parser.add_argument("--jobs", default=",".join(JOBS), help="comma separated jobs to run, in order")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per job, e.g. 2 to time incremental reruns")
+    parser.add_argument("--config", default="{}", help="JSON object merged into the generated config.json")
+    parser.add_argument("--json", default=None, help="write results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the working directory with logs and job output")
+    args = parser.parse_args()
+
+    data = Data(args.assets, args.templates, args.wallets, args.latency, args.poison)
+    server = serve(data)
+    path = tempfile.mkdtemp(prefix="nftv-bench-")
+    write_config(path, f"http://127.0.0.1:{server.server_address[1]}", args)
+
+    results = []
+    try:
+        for job in args.jobs.split(","):
+            for _ in range(args.repeat):
+                results.append(run(job, path, server))
+    finally:
+        server.shutdown()
+        if args.keep:
+            print(f"Working directory: {path}")
+        else:
+            shutil.rmtree(path)
+
+    show(results)
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump({"assets": args.assets, "latency": args.latency, "results": results}, file, indent=4)
@@ -0,0 +1,388 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from time import monotonic
+import hashlib
+import json
+import threading
+
+from base58 import b58decode, b58encode
+from eosapi import Action, Authorization, EosApi, Transaction, TransactionException
+from eosapi.packer import is_canonical, ripmed160
+
+from abi import Abi
+from common import base_url, count_rows, record, retryable, retry
+
+try:
+    import coincurve
+    from coincurve._libsecp256k1 import ffi
+except ImportError:
+    coincurve = None
+
+
+CPU_LIMIT = 150000
+NET_LIMIT = 524288
+HEADROOM = 0.5
+MAX_ACTIONS = 50
+SMOOTHING = 0.3
+TAPOS_TTL = 60
+EXPIRATION = 300
+CHAINS = {}
+CHAINS_LOCK = threading.Lock()
+
+def node_error(err):
+    # eosapi raises TransactionException for any 500, only a nodeos error body
+    # says the node itself refused the transaction, a proxy 500 says nothing
+    if not isinstance(err, TransactionException):
+        return None
+    try:
+        error = err.resp.json()["error"]
+        if "code" in error and "name" in error:
+            return error
+    except Exception:
+        pass
+    return None
+
+def rejected(err):
+    error = node_error(err)
+    return error is not None and error["name"] != "tx_duplicate"
+
+def resubmittable(err):
+    # A node rejection is deterministic, resending the same actions only burns time
+    if isinstance(err, TransactionException):
+        return node_error(err) is None
+    return retryable(err)
+
+def duplicate(err):
+    error = node_error(err)
+    return error is not None and error["name"] == "tx_duplicate"
+
+def expired(err):
+    error = node_error(err)
+    return error is not None and error["name"] == "expired_tx_exception"
+
+def missing(err):
+    error = node_error(err)
+    return error is not None and error["name"] == "tx_not_found"
+
+def transaction_id(body):
+    return hashlib.sha256(bytes.fromhex(body["packed_trx"])).hexdigest()
+
+def expiration(body):
+    # The packed header starts with the expiration as seconds since the epoch
+    return datetime.utcfromtimestamp(int.from_bytes(bytes.fromhex(body["packed_trx"])[:4], "little"))
+
+def native_key(private_key):
+    if private_key.startswith("PVT_K1_"):
+        secret = b58decode(private_key[7:])[:32]
+    else:
+        secret = b58decode(private_key)[1:33]
+    return coincurve.PrivateKey(secret)
+
+def sign_native(key, digest):
+    nonce = 0
+    while True:
+        # Fold a counter into RFC 6979 until the signature is canonical
+        ndata = ffi.new("unsigned char[32]", nonce.to_bytes(32, "big"))
+        signature = key.sign_recoverable(digest, hasher=None, custom_nonce=(ffi.NULL, ndata))
+        signature = bytes([signature[64] + 31]) + signature[:64]
+        if is_canonical(signature):
+            break
+        nonce += 1
+    return "SIG_K1_" + b58encode(signature + ripmed160(signature + b"K1")[:4]).decode("ascii")
+
+class Chain:
+    def __init__(self, api, ttl=TAPOS_TTL, native=True, history=None):
+        self.api = api
+        self.history = history or api.rpc_host
+        self.ttl = ttl
+        self.native = native and coincurve is not None
+        self.lock = threading.Lock()
+        self.info = None
+        self.fetched = 0
+        self.issued = {}
+        self.abi_lock = threading.Lock()
+        self.abis = {}
+        self.keys = {}
+        self.consensus = None
+
+    def post(self, url, body, metric):
+        # api.post bypasses common.request, so the bytes are recorded here,
+        # error responses included
+        sent = 0 if body is None else len(json.dumps(body))
+        try:
+            r = self.api.post(url, body)
+        except Exception as err:
+            response = getattr(err, "resp", None)
+            record(*metric, sent=sent, received=0 if response is None else len(response.content))
+            raise
+        record(*metric, sent=sent, received=len(r.content))
+        return r
+
+    def call(self, url, body, metric, check=retryable):
+        return retry(self.post, url, body, metric, check=check, metric=metric)
+
+    def limits(self):
+        with self.lock:
+            if self.consensus is None:
+                self.consensus = get_limits(self)
+            return self.consensus
+
+    def abi(self, account):
+        with self.abi_lock:
+            if account not in self.abis:
+                r = self.call(self.api.rpc_host + "/v1/chain/get_abi", {"account_name": account}, ("chain_read", "get_abi"))
+                self.abis[account] = Abi(r.json()["abi"])
+            return self.abis[account]
+
+    def binargs(self, account, name, data):
+        try:
+            return self.abi(account).pack_action(name, data)
+        except Exception:
+            # Types the local serializer does not know still go through the node
+            r = self.call(
+                self.api.rpc_host + "/v1/chain/abi_json_to_bin",
+                {"code": account, "action": name, "args": data},
+                ("chain_read", "abi_json_to_bin")
+            )
+            return bytes.fromhex(r.json()["binargs"])
+
+    def sign(self, trx, private_key):
+        if not self.native:
+            trx.sign(private_key)
+            return
+        if private_key not in self.keys:
+            self.keys[private_key] = native_key(private_key)
+        digest = hashlib.sha256(bytes.fromhex(trx.chain_id) + trx.pack() + b"\x00" * 32).digest()
+        trx.signatures.append(sign_native(self.keys[private_key], digest))
+
+    def reference(self):
+        with self.lock:
+            if self.info is None or monotonic() - self.fetched > self.ttl:
+                self.info = self.call(self.api.rpc_host + "/v1/chain/get_info", None, ("chain_read", "get_info")).json()
+                self.fetched = monotonic()
+            return self.info
+
+    def expire(self, digest):
+        # Identical actions built in the same second would otherwise share a
+        # transaction id and the second push would be rejected as a duplicate,
+        # only those move on to the next free second
+        with self.lock:
+            expiration = datetime.utcnow().replace(microsecond=0) + timedelta(seconds=EXPIRATION)
+            for second in [second for second in self.issued if second < expiration]:
+                del self.issued[second]
+            while digest in self.issued.get(expiration, ()):
+                expiration += timedelta(seconds=1)
+            self.issued.setdefault(expiration, set()).add(digest)
+            return expiration
+
+    def build(self, actions):
+        actors = []
+        items = []
+        for item in actions:
+            authorization = []
+            for auth in item["authorization"]:
+                authorization.append(Authorization(actor=auth["actor"], permission=auth["permission"]))
+                actor = f"{auth['actor']}-{auth['permission']}"
+                if actor not in actors:
+                    actors.append(actor)
+            items.append(Action(
+                account=item["account"],
+                name=item["name"],
+                authorization=authorization,
+                data=item["data"]
+            ))
+        trx = Transaction(actions=items)
+        for item in trx.actions:
+            item.link(self.binargs(item.account, item.name, item.data))
+
+        info = self.reference()
+        trx.link(info["last_irreversible_block_id"], info["chain_id"])
+        trx.expiration = self.expire(hashlib.sha256(b"".join(item.pack() for item in trx.actions)).digest())
+
+        signed = []
+        for actor in actors:
+            if actor in self.api.accounts and self.api.accounts[actor].private_key not in signed:
+                self.sign(trx, self.api.accounts[actor].private_key)
+                signed.append(self.api.accounts[actor].private_key)
+        return trx
+
+    def packed(self, trx):
+        return {
+            "signatures": trx.signatures,
+            "compression": False,
+            "packed_context_free_data": "",
+            "packed_trx": trx.pack().hex()
+        }
+
+    def send(self, body, count, resend=False):
+        attempts = []
+
+        def post():
+            attempts.append(1)
+            return self.post(self.api.rpc_host + "/v1/chain/push_transaction", body, ("push_transaction", "push_transaction"))
+
+        # Retries resend the same signed transaction, never a second copy
+        try:
+            output = retry(post, check=resubmittable, metric=("push_transaction", "push_transaction")).json()
+        except TransactionException as err:
+            # A duplicate of a copy sent earlier means the node already has it, on
+            # a first send it is an identical transaction from someone else
+            if not duplicate(err) or (len(attempts) < 2 and not resend):
+                raise
+            output = {"transaction_id": transaction_id(body)}
+        count_rows("push_transaction", count)
+        return output
+
+    def push(self, actions):
+        return self.send(self.packed(self.build(actions)), len(actions))
+
+    def lookup(self, body):
+        # True once the transaction executed, False when it provably never will,
+        # None when the history source cannot tell
+        try:
+            r = self.call(
+                self.history + "/v1/history/get_transaction",
+                {"id": transaction_id(body)},
+                ("chain_read", "get_transaction"),
+                check=resubmittable
+            )
+            return r.json()["trx"]["receipt"]["status"] == "executed"
+        except Exception as err:
+            if not missing(err):
+                return None
+        # Not found only counts once the source is irreversibly past the
+        # expiration, until then the transaction may still land
+        try:
+            r = self.call(self.history + "/v1/chain/get_info", None, ("chain_read", "get_info"))
+            irreversible = datetime.strptime(r.json()["last_irreversible_block_time"][:19], "%Y-%m-%dT%H:%M:%S")
+        except Exception:
+            return None
+        if irreversible <= expiration(body):
+            return None
+        return False
+
+def get_chain(ENV):
+    # One client per account and node, reused across runs in host.py
+    key = (ENV["rpc"], ENV["rpc_key"], ENV["acc"], ENV.get("native_signer", True), ENV.get("history", ""))
+    with CHAINS_LOCK:
+        if key not in CHAINS:
+            api = EosApi(rpc_host=base_url(ENV["rpc"]))
+            api.import_key(ENV["acc"], ENV["acc_key"], "active")
+            api.session.headers["apikey"] = ENV["rpc_key"]
+            history = base_url(ENV["history"]) if ENV.get("history") else None
+            CHAINS[key] = Chain(api, native=ENV.get("native_signer", True), history=history)
+        return CHAINS[key]
+
+def reset_abis():
+    # Chains outlive a run in host.py, ABIs are only trusted for one run so a
+    # contract upgrade is picked up by the next job
+    with CHAINS_LOCK:
+        chains = list(CHAINS.values())
+    for chain in chains:
+        with chain.abi_lock:
+            chain.abis.clear()
+
+def error_message(err):
+    try:
+        error = json.loads(str(err).replace("transaction error: ", ""))
+        return error["error"]["details"][0]["message"]
+    except Exception:
+        return str(err)
+
+def get_limits(chain):
+    try:
+        r = chain.call(
+            chain.api.rpc_host + "/v1/chain/get_consensus_parameters",
+            None,
+            ("chain_read", "get_consensus_parameters")
+        )
+        config = r.json()["chain_config"]
+        return int(config["max_transaction_cpu_usage"]), int(config["max_transaction_net_usage"])
+    except Exception:
+        return CPU_LIMIT, NET_LIMIT
+
+class Packer:
+    def __init__(self, submit, on_success, on_failure, size=1, max_actions=MAX_ACTIONS, limits=(CPU_LIMIT, NET_LIMIT), window=1):
+        self.submit = submit
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.size = size
+        self.max_actions = max_actions
+        self.cpu_budget = limits[0] * HEADROOM
+        self.net_budget = limits[1] * HEADROOM
+        self.cpu = None
+        self.net = None
+        self.lock = threading.Lock()
+        self.pending = []
+        self.executor = None
+        self.slots = threading.Semaphore(window)
+        self.futures = []
+        if window > 1:
+            self.executor = ThreadPoolExecutor(max_workers=window)
+
+    def add(self, action, item):
+        batch = None
+        with self.lock:
+            self.pending.append((action, item))
+            if len(self.pending) >= self.size:
+                batch, self.pending = self.pending, []
+        if batch is not None:
+            self.dispatch(batch)
+
+    def dispatch(self, batch):
+        if self.executor is None:
+            self.send(batch)
+            return
+        # Bound the number of transactions in flight
+        self.slots.acquire()
+        future = self.executor.submit(self.send, batch)
+        future.add_done_callback(lambda item: self.slots.release())
+        self.futures.append(future)
+
+    def flush(self):
+        with self.lock:
+            batch, self.pending = self.pending, []
+        if len(batch) > 0:
+            self.dispatch(batch)
+        futures, self.futures = self.futures, []
+        for future in futures:
+            future.result()
+
+    def send(self, batch):
+        try:
+            result = self.submit([action for action, item in batch])
+        except Exception as err:
+            # Anything but a node rejection may have applied, re-signing it as
+            # two new transactions could run every action twice
+            if len(batch) < 2 or not rejected(err):
+                self.on_failure([item for action, item in batch], err)
+                return
+            # Split the rejected batch to isolate the bad action(s)
+            with self.lock:
+                self.size = max(1, len(batch) // 2)
+            half = len(batch) // 2
+            self.send(batch[:half])
+            self.send(batch[half:])
+            return
+        self.observe(result, len(batch))
+        self.on_success(result["transaction_id"], [item for action, item in batch])
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def observe(self, result, count):
+        try:
+            receipt = result["processed"]["receipt"]
+            cpu = receipt["cpu_usage_us"] / count
+            net = receipt["net_usage_words"] * 8 / count
+        except (KeyError, TypeError, ZeroDivisionError):
+            return
+        with self.lock:
+            if self.cpu is None:
+                self.cpu, self.net = cpu, net
+            else:
+                self.cpu += SMOOTHING * (cpu - self.cpu)
+                self.net += SMOOTHING * (net - self.net)
+            size = min(self.cpu_budget / max(self.cpu, 1), self.net_budget / max(self.net, 1))
+            self.size = max(1, min(self.max_actions, int(size)))
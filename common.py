@@ -1,20 +1,555 @@
-from time import sleep
+from time import monotonic, perf_counter, sleep, time
+from urllib.parse import urlsplit
 import requests
+from requests.adapters import HTTPAdapter
+import atexit
+import bisect
+import gzip
 import json
 import logging
 import logging.handlers
 import os
+import queue
+import random
+import shutil
+import sqlite3
 import sys
+import threading
+
+from tendo import singleton
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 SLEEP = 1
 SUCCESS = 5832585
 FAIL = 16734296
 TIMEOUT = 60
+RETRY = 3
+BACKOFF = 0.5
+BACKOFF_MAX = 30
+POOL_SIZE = 32
+PAGE_LIMIT = 100
+PAGE_MIN = 10
+PAGE_MAX = 1000
+PAGE_TARGET = 2
+PAGE_BYTES = 8 * 1024 * 1024
+RPC_LIMIT = 1000
+PREFETCH = 2
+QUEUE_DEPTH = 8
+BATCH_ROWS = 5000
+BATCH_BYTES = 4 * 1024 * 1024
+BATCH_WAIT = 5
+HTTP = {"session": None, "pool_size": POOL_SIZE, "http2": False}
+HTTP_LOCK = threading.Lock()
+HOST = {"config": None}
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+METRICS = {}
+ROWS = {}
+METRICS_LOCK = threading.Lock()
+START = perf_counter()
+LOG_FORMAT = "%(asctime)s:%(levelname)s:%(name)s: %(message)s"
+LOG_BYTES = 1024 * 1024
+LOG_BACKUPS = 5
+ALERT_WAIT = 2
+ALERT_AGE = 60
+ALERT_LENGTH = 4000
+ALERT_FLUSH = 5
+ALERTER = None
+ALERTER_LOCK = threading.Lock()
 
-def post_alert(type, job, msg):
+def host_config(config):
+    HOST["config"] = config
+
+def load_config():
+    # Jobs started by host.py share its config, standalone runs read the file
+    if HOST["config"] is not None:
+        return HOST["config"]
     with open("config.json") as file:
-        ENV = json.load(file)
+        return json.load(file)
+
+def single_instance(flavor_id=""):
+    # host.py never overlaps runs of the same job, so the file lock is only
+    # needed when a script is started on its own
+    if HOST["config"] is not None:
+        return None
+    return singleton.SingleInstance(flavor_id=flavor_id)
+
+def base_url(host):
+    # Hosts in config.json are bare names served over https, unless they
+    # carry their own scheme (local stand-ins, plain http proxies)
+    if "://" in host:
+        return host.rstrip("/")
+    return "https://" + host
+
+def configure_http(pool_size=POOL_SIZE, http2=False):
+    with HTTP_LOCK:
+        # A hosted job keeps the warm pool when it asks for the same settings
+        if HTTP["session"] is not None and HTTP["pool_size"] == pool_size and HTTP["http2"] == http2:
+            return
+        if HTTP["session"] is not None:
+            HTTP["session"].close()
+        HTTP["session"] = None
+        HTTP["pool_size"] = pool_size
+        HTTP["http2"] = http2
+
+def get_session():
+    with HTTP_LOCK:
+        if HTTP["session"] is None:
+            HTTP["session"] = new_session(HTTP["pool_size"], HTTP["http2"])
+        return HTTP["session"]
+
+def new_session(pool_size, http2):
+    if http2 and httpx is not None:
+        try:
+            return httpx.Client(
+                http2=True,
+                limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+            )
+        except ImportError:
+            # httpx without the h2 extra, fall back to HTTP/1.1 keep-alive
+            pass
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def backoff(attempt):
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF * 2 ** attempt))
+
+def retryable(err):
+    # requests keeps the response in .response, eosapi exceptions in .resp
+    response = getattr(err, "response", None)
+    if response is None:
+        response = getattr(err, "resp", None)
+    if response is None:
+        return True
+    return response.status_code in (408, 425, 429) or response.status_code >= 500
+
+def retry(func, *args, check=retryable, metric=None, **kwargs):
+    retry_count = 0
+    start = perf_counter()
+    while True:
+        try:
+            output = func(*args, **kwargs)
+            if metric is not None:
+                record(*metric, elapsed=perf_counter() - start, retries=retry_count)
+            return output
+        except Exception as err:
+            retry_count += 1
+            if retry_count >= RETRY or not check(err):
+                if metric is not None:
+                    record(*metric, elapsed=perf_counter() - start, retries=retry_count - 1, error=True)
+                raise err
+            sleep(backoff(retry_count))
+
+def loads(data):
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def dumps(value):
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, separators=(",", ":")).encode()
+
+def projection(*paths):
+    # Dotted paths to a nested spec, "data.name" keeps only name under data
+    spec = {}
+    for path in paths:
+        node = spec
+        parts = path.split(".")
+        for part in parts[:-1]:
+            node = node.setdefault(part, {})
+        node[parts[-1]] = None
+    return spec
+
+def project(value, spec):
+    if spec is None or value is None:
+        return value
+    if isinstance(value, list):
+        return [project(item, spec) for item in value]
+    output = {}
+    for key, child in spec.items():
+        if key in value:
+            output[key] = value[key] if child is None else project(value[key], child)
+    return output
+
+def classify(method, url):
+    path = urlsplit(url).path
+    if "/atomicassets/" in path or "/atomicmarket/" in path:
+        return "atomicassets", path.replace("/v1/", "/").strip("/")
+    if "/rest/v1/" in path:
+        endpoint = path.split("/rest/v1/", 1)[1].strip("/")
+        if method == "GET" or endpoint.startswith("rpc/"):
+            return "supabase_read", endpoint
+        if method == "DELETE":
+            return "delete", endpoint
+        return "upsert", endpoint
+    return "other", urlsplit(url).netloc
+
+def request(method, url, metric=None, **kwargs):
+    kwargs.setdefault("timeout", TIMEOUT)
+    session = get_session()
+    if httpx is not None and isinstance(session, httpx.Client) and "data" in kwargs:
+        kwargs["content"] = kwargs.pop("data")
+    if metric is None:
+        metric = classify(method, url)
+
+    def send():
+        r = session.request(method, url, **kwargs)
+        body = r.request.content if httpx is not None and isinstance(r, httpx.Response) else r.request.body
+        record(*metric, sent=len(body or b""), received=len(r.content))
+        if r.status_code == 429:
+            sleep(retry_after(r))
+        r.raise_for_status()
+        return r
+
+    return retry(send, metric=metric)
+
+def retry_after(r):
+    try:
+        return min(BACKOFF_MAX, float(r.headers.get("Retry-After", 0)))
+    except ValueError:
+        return 0
+
+def record(stage, endpoint, elapsed=None, retries=0, error=False, sent=0, received=0):
+    with METRICS_LOCK:
+        item = METRICS.get((stage, endpoint))
+        if item is None:
+            item = METRICS[(stage, endpoint)] = {
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "seconds": 0.0,
+                "max_seconds": 0.0,
+                "buckets": [0] * (len(BUCKETS) + 1)
+            }
+        item["retries"] += retries
+        item["errors"] += int(error)
+        item["bytes_sent"] += sent
+        item["bytes_received"] += received
+        if elapsed is not None:
+            item["calls"] += 1
+            item["seconds"] += elapsed
+            item["max_seconds"] = max(item["max_seconds"], elapsed)
+            item["buckets"][bisect.bisect_left(BUCKETS, elapsed)] += 1
+
+def reset_metrics():
+    global START
+    with METRICS_LOCK:
+        METRICS.clear()
+        ROWS.clear()
+        START = perf_counter()
+
+def count_rows(stage, rows):
+    with METRICS_LOCK:
+        ROWS[stage] = ROWS.get(stage, 0) + rows
+
+def quantile(item, q):
+    # Upper bound of the bucket holding the quantile, the slowest call past the last bucket
+    total = sum(item["buckets"])
+    if total < 1:
+        return 0
+    seen = 0
+    for bound, value in zip(BUCKETS, item["buckets"]):
+        seen += value
+        if seen >= q * total:
+            return bound
+    return round(item["max_seconds"], 6)
+
+class PageSize:
+    def __init__(self, limit=PAGE_LIMIT, maximum=PAGE_MAX, target=PAGE_TARGET, max_bytes=PAGE_BYTES):
+        self.limit = limit
+        self.maximum = maximum
+        self.target = target
+        self.max_bytes = max_bytes
+
+    def update(self, elapsed, size, rows):
+        if rows < 1:
+            return
+        limit = self.limit
+        if elapsed > self.target:
+            limit //= 2
+        elif elapsed < self.target / 2:
+            limit *= 2
+        # Keep pages under the byte budget at the observed row size
+        cap = min(self.maximum, int(self.max_bytes * rows / max(size, 1)))
+        self.limit = max(PAGE_MIN, min(limit, cap))
+
+def paginate(fetch, key="asset_id", limit=PAGE_LIMIT, maximum=PAGE_MAX, fields=None, bound=0):
+    size = PageSize(limit, maximum)
+    while True:
+        start = perf_counter()
+        r = fetch(bound, size.limit)
+        # Pages are trimmed to the fields the job reads before they are queued
+        data = project(loads(r.content)["data"], fields)
+        size.update(perf_counter() - start, len(r.content), len(data))
+        count_rows("atomicassets", len(data))
+        if len(data) < 1:
+            return
+        yield data
+        bound = int(data[-1][key]) + 1
+
+def offset_pages(fetch, limit=RPC_LIMIT):
+    offset = 0
+    while True:
+        data = loads(fetch(offset, limit).content)
+        if len(data) < 1:
+            return
+        yield data
+        # Advance by what came back, a server row cap below the limit must not skip rows
+        offset += len(data)
+
+def rpc_rows(fetch, limit=RPC_LIMIT):
+    for data in prefetch(offset_pages(fetch, limit)):
+        yield from data
+
+def prefetch(iterable, depth=PREFETCH):
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def offer(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not offer((item, None)):
+                    return
+            offer((done, None))
+        except Exception as err:
+            offer((None, err))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, err = items.get()
+            if err is not None:
+                raise err
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+
+class Writer:
+    def __init__(self, func, on_error=None, workers=1, depth=QUEUE_DEPTH):
+        self.func = func
+        self.on_error = on_error
+        self.failed = 0
+        self.lock = threading.Lock()
+        self.items = queue.Queue(maxsize=depth)
+        self.threads = [threading.Thread(target=self.run, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, *args):
+        # Blocks while the queue is full so producers cannot outrun the writes
+        self.items.put(args)
+
+    def run(self):
+        while True:
+            args = self.items.get()
+            if args is None:
+                return
+            try:
+                self.func(*args)
+            except Exception as err:
+                with self.lock:
+                    self.failed += 1
+                if self.on_error is not None:
+                    # A failing handler must not take the writer thread down with it
+                    try:
+                        self.on_error(err, *args)
+                    except Exception:
+                        logging.exception("Writer error handler failed")
+
+    def close(self):
+        for _ in self.threads:
+            self.items.put(None)
+        for thread in self.threads:
+            thread.join()
+        return self.failed
+
+class Buffer:
+    def __init__(self, flush, key="asset_id", max_rows=BATCH_ROWS, max_bytes=BATCH_BYTES, max_wait=BATCH_WAIT):
+        self.flush = flush
+        self.key = key
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_wait = max_wait
+        self.lock = threading.Lock()
+        self.rows = {}
+        self.meta = []
+        self.size = 0
+        self.since = None
+        self.closed = threading.Event()
+        self.timer = threading.Thread(target=self.tick, daemon=True)
+        self.timer.start()
+
+    def add(self, rows, meta=None):
+        self.add_encoded([(row[self.key], dumps(row)) for row in rows], meta)
+
+    def add_encoded(self, rows, meta=None):
+        # Rows as (key, JSON bytes) pairs, for callers that serialize their own records
+        batch = None
+        with self.lock:
+            for key, row in rows:
+                # Later rows for the same key replace earlier ones, a batch
+                # may not upsert the same row twice
+                previous = self.rows.get(key)
+                if previous is not None:
+                    self.size -= len(previous) + 1
+                self.rows[key] = row
+                self.size += len(row) + 1
+            if meta is not None:
+                self.meta.append(meta)
+            if self.since is None:
+                self.since = monotonic()
+            if len(self.rows) >= self.max_rows or self.size >= self.max_bytes:
+                batch = self.take()
+        if batch is not None:
+            self.flush(*batch)
+
+    def take(self):
+        if len(self.rows) < 1:
+            return None
+        body = b"[" + b",".join(self.rows.values()) + b"]"
+        batch = (body, self.meta)
+        self.rows = {}
+        self.meta = []
+        self.size = 0
+        self.since = None
+        return batch
+
+    def tick(self):
+        while not self.closed.wait(1):
+            batch = None
+            with self.lock:
+                if self.since is not None and monotonic() - self.since >= self.max_wait:
+                    batch = self.take()
+            if batch is not None:
+                self.flush(*batch)
+
+    def close(self):
+        self.closed.set()
+        self.timer.join()
+        with self.lock:
+            batch = self.take()
+        if batch is not None:
+            self.flush(*batch)
+
+def json_body(body, compress=False):
+    headers = {"Content-Type": "application/json"}
+    if compress:
+        body = gzip.compress(body, compresslevel=5)
+        headers["Content-Encoding"] = "gzip"
+    return body, headers
+
+def open_state(path):
+    db = sqlite3.connect(path, timeout=TIMEOUT, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+class Alerter:
+    def __init__(self, env, wait=ALERT_WAIT, age=ALERT_AGE):
+        self.env = env
+        self.wait = wait
+        self.age = age
+        self.ready = 0
+        self.held = {}
+        self.taken = 0
+        self.items = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def post(self, type, job, msg):
+        self.items.put((type, job, msg))
+
+    def limit(self, type):
+        # Failures are summed up per job until the run flushes them, a watch
+        # loop that never ends still gets a summary every age seconds
+        return self.age if type == "fail" else self.wait
+
+    def due(self):
+        if len(self.held) < 1:
+            return None
+        return max(0, min(since + self.limit(type) for (type, job), (since, messages) in self.held.items()) - monotonic())
+
+    def run(self):
+        while True:
+            try:
+                item = self.items.get(timeout=self.due())
+                self.taken += 1
+            except queue.Empty:
+                item = False
+            if item:
+                type, job, msg = item
+                since, messages = self.held.setdefault((type, job), (monotonic(), {}))
+                messages[msg] = messages.get(msg, 0) + 1
+            now = monotonic()
+            for (type, job), (since, messages) in list(self.held.items()):
+                # None closes and () flushes, both send everything held
+                if item is None or item == () or now - since >= self.limit(type):
+                    del self.held[(type, job)]
+                    self.send(type, job, messages)
+            if len(self.held) < 1:
+                for _ in range(self.taken):
+                    self.items.task_done()
+                self.taken = 0
+            if item is None:
+                return
+
+    def send(self, type, job, messages):
+        sleep(max(0, self.ready - monotonic()))
+        try:
+            r = request("POST", self.env["webhook"], metric=("alert", "webhook"), json=alert_body(self.env, type, job, messages))
+            # Wait out an exhausted bucket instead of running into a 429
+            wait = SLEEP
+            if r.headers.get("X-RateLimit-Remaining") == "0":
+                wait = min(BACKOFF_MAX, float(r.headers.get("X-RateLimit-Reset-After", SLEEP)))
+            self.ready = monotonic() + wait
+        except Exception:
+            logging.getLogger(job).exception(f"Sending {sum(messages.values())} alerts failed")
+
+    def flush(self, timeout):
+        # Sends everything held, then Queue.join with a deadline, a hanging
+        # webhook must not hold up the caller
+        self.items.put(())
+        deadline = monotonic() + timeout
+        with self.items.all_tasks_done:
+            while self.items.unfinished_tasks > 0:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    return False
+                self.items.all_tasks_done.wait(remaining)
+        return True
+
+    def close(self):
+        self.items.put(None)
+        self.thread.join(TIMEOUT)
+
+def alert_body(ENV, type, job, messages):
     if type == "pass":
         color = SUCCESS
         title = f"{job} - PASSED"
@@ -23,33 +558,194 @@ def post_alert(type, job, msg):
         color = FAIL
         title = f"{job} - FAILED"
         content = ENV["mention"]
-    output = {
+    total = sum(messages.values())
+    if total > 1:
+        title += f" ({total} alerts)"
+    lines = [(msg if count == 1 else f"{msg} (x{count})")[:ALERT_LENGTH // 2] for msg, count in messages.items()]
+    description = ""
+    for k, line in enumerate(lines):
+        if len(description) + len(line) + 1 > ALERT_LENGTH:
+            description += f"... {len(lines) - k} more"
+            break
+        description += line + "\n"
+    return {
         "content": content,
         "embeds": [
             {
                 "title": title,
                 "color": color,
-                "description": msg
+                "description": description.strip()
             }
         ],
         "attachments": []
     }
 
-    r = requests.post(ENV["webhook"], json=output, timeout=TIMEOUT)
-    r.raise_for_status()
-    sleep(SLEEP)
+def get_alerter():
+    global ALERTER
+    with ALERTER_LOCK:
+        if ALERTER is None:
+            ALERTER = Alerter(load_config())
+            # Registered after the logger so pending alerts are sent while it still runs
+            atexit.register(ALERTER.close)
+        return ALERTER
+
+def post_alert(type, job, msg):
+    get_alerter().post(type, job, msg)
+
+def metrics_summary(job, status, elapsed):
+    stages = {}
+    with METRICS_LOCK:
+        for (stage, endpoint), item in sorted(METRICS.items()):
+            summary = stages.setdefault(stage, {
+                "calls": 0,
+                "errors": 0,
+                "retries": 0,
+                "rows": ROWS.get(stage, 0),
+                "bytes_sent": 0,
+                "bytes_received": 0,
+                "seconds": 0.0,
+                "endpoints": {}
+            })
+            for key in ("calls", "errors", "retries", "bytes_sent", "bytes_received", "seconds"):
+                summary[key] += item[key]
+            summary["endpoints"][endpoint] = {
+                "calls": item["calls"],
+                "errors": item["errors"],
+                "retries": item["retries"],
+                "bytes_sent": item["bytes_sent"],
+                "bytes_received": item["bytes_received"],
+                "seconds": round(item["seconds"], 6),
+                "mean_seconds": round(item["seconds"] / item["calls"], 6) if item["calls"] > 0 else 0,
+                "p50_seconds": quantile(item, 0.5),
+                "p95_seconds": quantile(item, 0.95),
+                "max_seconds": round(item["max_seconds"], 6)
+            }
+        for stage, rows in ROWS.items():
+            stages.setdefault(stage, {"rows": rows, "endpoints": {}})
+    for summary in stages.values():
+        if "seconds" in summary:
+            summary["seconds"] = round(summary["seconds"], 6)
+    return {
+        "job": job,
+        "status": status,
+        "seconds": round(elapsed, 3),
+        "finished": round(time(), 3),
+        "stages": stages
+    }
+
+def metrics_text(job, status, elapsed):
+    lines = []
+
+    def family(name, type, help):
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} {type}")
+
+    with METRICS_LOCK:
+        items = sorted(METRICS.items())
+        rows = sorted(ROWS.items())
+
+    family("nftv_request_seconds", "histogram", "Time per call by stage and endpoint, retries included")
+    for (stage, endpoint), item in items:
+        labels = f'job="{job}",stage="{stage}",endpoint="{endpoint}"'
+        seen = 0
+        for bound, value in zip(BUCKETS + ("+Inf",), item["buckets"]):
+            seen += value
+            lines.append(f'nftv_request_seconds_bucket{{{labels},le="{bound}"}} {seen}')
+        lines.append(f"nftv_request_seconds_sum{{{labels}}} {item['seconds']:.6f}")
+        lines.append(f"nftv_request_seconds_count{{{labels}}} {item['calls']}")
+    for key, name, help in (
+        ("errors", "nftv_request_errors_total", "Calls that failed after retries"),
+        ("retries", "nftv_request_retries_total", "Retried attempts"),
+        ("bytes_sent", "nftv_request_sent_bytes_total", "Request body bytes sent"),
+        ("bytes_received", "nftv_request_received_bytes_total", "Response body bytes received")
+    ):
+        family(name, "counter", help)
+        for (stage, endpoint), item in items:
+            lines.append(f'{name}{{job="{job}",stage="{stage}",endpoint="{endpoint}"}} {item[key]}')
+    family("nftv_rows_total", "counter", "Rows or actions handled by stage")
+    for stage, value in rows:
+        lines.append(f'nftv_rows_total{{job="{job}",stage="{stage}"}} {value}')
+    family("nftv_job_duration_seconds", "gauge", "Wall time of the last run")
+    lines.append(f'nftv_job_duration_seconds{{job="{job}"}} {elapsed:.3f}')
+    family("nftv_job_status", "gauge", "Exit status of the last run")
+    lines.append(f'nftv_job_status{{job="{job}"}} {status}')
+    family("nftv_job_last_run_timestamp_seconds", "gauge", "Unix time the last run finished")
+    lines.append(f'nftv_job_last_run_timestamp_seconds{{job="{job}"}} {time():.3f}')
+    return "\n".join(lines) + "\n"
+
+def write_metrics(job, status, wait=ALERT_FLUSH):
+    # Written next to the logs unless config.json names a textfile collector
+    # directory, files are replaced atomically so scrapes never see a partial run
+    try:
+        # Pending alerts are part of the run, as far as they go out in time,
+        # wait=0 leaves them to the dispatcher's own schedule
+        if ALERTER is not None and wait > 0:
+            ALERTER.flush(wait)
+        ENV = load_config()
+        directory = ENV.get("metrics") or ENV["logs"]
+        elapsed = perf_counter() - START
+        for name, content in (
+            (f"{job}.prom", metrics_text(job, status, elapsed)),
+            (f"{job}.json", json.dumps(metrics_summary(job, status, elapsed), indent=4))
+        ):
+            path = os.path.join(directory, name)
+            with open(path + ".tmp", "w") as file:
+                file.write(content)
+            os.replace(path + ".tmp", path)
+    except Exception:
+        logging.exception("Writing metrics failed")
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        # Per-asset DEBUG events are sampled, everything above always passes
+        return record.levelno > logging.DEBUG or random.random() < self.rate
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        return json.dumps({
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "name": record.name,
+            "message": record.getMessage()
+        })
+
+def compress_log(source, dest):
+    with open(source, "rb") as input, gzip.open(dest, "wb") as output:
+        shutil.copyfileobj(input, output)
+    os.remove(source)
 
 def setup_logger(name):
-    with open("config.json") as file:
-        ENV = json.load(file)
     logger = logging.getLogger(name)
-    logger.setLevel(logging.INFO)
-    handler = logging.handlers.RotatingFileHandler(filename=os.path.join(ENV["logs"], f"{name}.log"),
-        maxBytes=1024 * 1024, backupCount=5)
-    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
-    logger.addHandler(handler)
-    handler = logging.StreamHandler(sys.stderr)
-    handler.setFormatter(logging.Formatter('%(asctime)s:%(levelname)s:%(name)s: %(message)s'))
+    # Safe to call again from the same process, handlers are only added once
+    if logger.handlers:
+        return logger
+    ENV = load_config()
+    logger.setLevel(getattr(logging, ENV.get("log_level", "INFO").upper()))
+    if ENV.get("log_json", False):
+        handler = logging.handlers.RotatingFileHandler(filename=os.path.join(ENV["logs"], f"{name}.jsonl"),
+            maxBytes=LOG_BYTES, backupCount=LOG_BACKUPS)
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler = logging.handlers.RotatingFileHandler(filename=os.path.join(ENV["logs"], f"{name}.log"),
+            maxBytes=LOG_BYTES, backupCount=LOG_BACKUPS)
+        handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    if ENV.get("log_compress", False):
+        handler.namer = lambda path: path + ".gz"
+        handler.rotator = compress_log
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    # File and console writes happen on the listener thread, QueueHandler still
+    # formats each record in the calling thread so later mutations cannot leak in
+    listener = logging.handlers.QueueListener(queue.SimpleQueue(), handler, stream)
+    handler = logging.handlers.QueueHandler(listener.queue)
+    handler.addFilter(SampleFilter(ENV.get("log_sample", 1)))
     logger.addHandler(handler)
+    listener.start()
+    atexit.register(listener.stop)
 
     return logger
\ No newline at end of file
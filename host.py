@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+import os
+from time import monotonic
+import runpy
+import signal
+import sys
+import threading
+
+from tendo import singleton
+
+from chain import reset_abis
+from common import host_config, load_config, post_alert, reset_metrics, setup_logger
+
+
+NAME = os.path.splitext(os.path.basename(__file__))[0]
+ROOT = os.path.dirname(os.path.abspath(__file__))
+JOBS = ["nftv", "nftv2", "pawsome", "sale_warn", "ticket"]
+STOP = threading.Event()
+
+def run(job):
+    path = os.path.join(ROOT, f"{job}.py")
+    argv = sys.argv
+    sys.argv = [path]
+    reset_metrics()
+    reset_abis()
+    start = monotonic()
+    try:
+        runpy.run_path(path, run_name="__main__")
+        status = 0
+    except SystemExit as err:
+        status = err.code or 0
+    except Exception as err:
+        msg = f"{job}: Run failed, {str(err)}"
+        logger.exception(msg, exc_info=err)
+        post_alert("fail", NAME, msg)
+        status = 1
+    finally:
+        sys.argv = argv
+    logger.info(f"{job}: Finished with status {status} in {monotonic() - start:.1f}s")
+    return status
+
+def stop(signum, frame):
+    logger.info("Stopping after the current run")
+    STOP.set()
+
+try:
+    logger = setup_logger(NAME)
+    try:
+        me = singleton.SingleInstance()
+    except:
+        msg = "Already running, exiting"
+        logger.error(msg)
+        post_alert("fail", NAME, msg)
+        exit(1)
+
+    ENV = load_config()
+    host_config(ENV)
+    schedule = {job: ENV["schedule"][job] for job in JOBS if job in ENV.get("schedule", {})}
+    if len(schedule) < 1:
+        msg = "No jobs scheduled, exiting"
+        logger.error(msg)
+        post_alert("fail", NAME, msg)
+        exit(1)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    # Runs happen one at a time, so a job never overlaps itself and each run
+    # gets the metrics to itself, a late job starts as soon as the last one ends
+    due = {job: monotonic() for job in schedule}
+    while not STOP.is_set():
+        job = min(due, key=due.get)
+        if STOP.wait(max(0, due[job] - monotonic())):
+            break
+        started = monotonic()
+        run(job)
+        due[job] = max(started + schedule[job], monotonic())
+except Exception as err:
+    msg = f"Main loop failed, {str(err)}"
+    logger.exception(msg, exc_info=err)
+    post_alert("fail", NAME, msg)
+    exit(1)
@@ -1,207 +1,430 @@
 #!/usr/bin/python3
 import os
-from time import sleep
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
 import json
+import threading
 
-import requests
-from tendo import singleton
-
-from common import post_alert, setup_logger
+from common import POOL_SIZE, Buffer, Writer, base_url, configure_http, count_rows, json_body, load_config, loads, open_state, paginate, post_alert, prefetch, project, projection, request, rpc_rows, setup_logger, single_instance, write_metrics
 
 
 NAME = os.path.splitext(os.path.basename(__file__))[0]
 ENV = {}
-AH = "https://{}/atomicassets/v1/assets?collection_name={}&template_id={}&page={}&limit=100&order=asc&sort=asset_id"
-TRANSFERS = "https://{}/atomicassets/v1/transfers?asset_id={}&page=1&limit=100&order=desc"
+AH = "{}/atomicassets/v1/assets?collection_name={}&template_id={}&lower_bound={}&limit={}&order=asc&sort=asset_id"
+TRANSFERS = "{}/atomicassets/v1/transfers?asset_id={}&after={}&page={}&limit=100&order=desc&sort=created"
+ASSET_FIELDS = projection(
+    "asset_id",
+    "owner",
+    "template_mint",
+    "data.name",
+    "mutable_data",
+    "template.max_supply",
+    "template.issued_supply",
+    "transferred_at_block",
+    "transferred_at_time"
+)
+TRANSFER_FIELDS = projection("sender_name", "assets.asset_id")
 HEADERS = {
     "apikey": "",
     "Authorization": "Bearer ",
-    "Prefer": "resolution=merge-duplicates"
+    "Prefer": "resolution=merge-duplicates,return=minimal"
 }
 RATES = "drip_template_data"
 ASSETS = "drip_asset_data2"
 CONFIG = "drip_config"
 TEMPLATES = "get_templates"
 BLOCK = "blocklist_main"
-RETRY = 3
-SLEEP = 1
+SHARED = '"collection":{},"template_id":{},"name":{},"max_supply":{},"issued_supply":{},'
+ROW = (
+    '{{"asset_id":{},{}"owner":{},"mint_number":{},"drip_amount":{},"mint_number_bonus":{},'
+    '"gross_drip_amount":{},"throttle_tax_reducer":{},"net_drip_amount":{}}}'
+)
 THROTTLE = 0
-TIMEOUT = 60
+WORKERS = 8
+SENDER_WORKERS = 4
+SENDER_BATCH = 50
+UPLOAD_WORKERS = 2
+DELETE_BATCH = 300
+SENDERS = None
+WRITER = None
+BUFFER = None
+STATE = None
+STATE_LOCK = threading.Lock()
 
 def get_block():
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                ENV["supabase_url"] + BLOCK + "?select=*",
-                headers=HEADERS,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    r = request(
+        "GET",
+        ENV["supabase_url"] + BLOCK + "?select=collection",
+        headers=HEADERS
+    )
+    return loads(r.content)
 
 def get_rates():
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                ENV["supabase_url"] + RATES + "?select=*&order=collection.asc,template_id.asc",
-                headers=HEADERS,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    r = request(
+        "GET",
+        ENV["supabase_url"] + RATES + "?select=collection,template_id,drip_amount,ownership,mint_bonuses,throttle"
+            "&order=collection.asc,template_id.asc",
+        headers=HEADERS
+    )
+    return loads(r.content)
 
 def get_config():
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                ENV["supabase_url"] + CONFIG + "?select=*",
-                headers=HEADERS,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
-
-def get_assets(collection, template_id, page):
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                AH.format(ENV["aa"], collection, template_id, page),
-                headers={"apikey": ENV["aa_key"]},
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()["data"]
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    r = request(
+        "GET",
+        ENV["supabase_url"] + CONFIG + "?select=config,value",
+        headers=HEADERS
+    )
+    return loads(r.content)
 
-def get_sender(asset_id):
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                TRANSFERS.format(ENV["aa"], asset_id),
-                headers={"apikey": ENV["aa_key"]},
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()["data"][0]["sender_name"]
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+def get_assets(collection, template_id, bound, limit):
+    return request(
+        "GET",
+        AH.format(base_url(ENV["aa"]), collection, template_id, bound, limit),
+        headers={"apikey": ENV["aa_key"]}
+    )
 
-def upload_assets(data):
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.post(
-                ENV["supabase_url"] + ASSETS,
-                headers=HEADERS,
-                json=data,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
+def get_senders(assets):
+    output = {}
+    ids = ",".join(str(item) for item in assets)
+    after = min(item[1] for item in assets.values()) - 1
+    page = 1
+    while len(output) < len(assets):
+        r = request(
+            "GET",
+            TRANSFERS.format(base_url(ENV["aa"]), ids, after, page),
+            headers={"apikey": ENV["aa_key"]}
+        )
+        data = project(loads(r.content)["data"], TRANSFER_FIELDS)
+        # Newest first, so the first transfer seen per asset is the one into custody
+        for transfer in data:
+            for asset in transfer["assets"]:
+                asset_id = int(asset["asset_id"])
+                if asset_id in assets and asset_id not in output:
+                    output[asset_id] = transfer["sender_name"]
+        if len(data) < 100:
             break
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+        page += 1
+    return output
+
+def upload_assets(body):
+    data, headers = json_body(body, ENV.get("gzip", False))
+    request(
+        "POST",
+        ENV["supabase_url"] + ASSETS,
+        headers={**HEADERS, **headers},
+        data=data
+    )
+
+def get_templates(offset, limit):
+    return request(
+        "POST",
+        ENV["supabase_url"] + "/rpc/" + TEMPLATES,
+        headers=HEADERS,
+        json={"lim": limit, "off": offset}
+    )
 
-def get_templates():
-    retry_count = 0
-    output = []
-    params = {"lim": 1000, "off": 0}
+def get_stored(template_id):
+    output = set()
+    last = 0
     while True:
+        r = request(
+            "GET",
+            ENV["supabase_url"] + ASSETS + f"?select=asset_id&template_id=eq.{template_id}&asset_id=gt.{last}&order=asset_id.asc&limit=1000",
+            headers=HEADERS
+        )
+        data = loads(r.content)
+        if len(data) < 1:
+            return output
+        output.update(item["asset_id"] for item in data)
+        last = data[-1]["asset_id"]
+
+def del_assets(template_ids):
+    for k in range(0, len(template_ids), DELETE_BATCH):
+        ids = ",".join(str(item) for item in template_ids[k:k + DELETE_BATCH])
+        request(
+            "DELETE",
+            ENV["supabase_url"] + ASSETS + f"?template_id=in.({ids})",
+            headers=HEADERS
+        )
+
+def del_stale(asset_ids):
+    for k in range(0, len(asset_ids), DELETE_BATCH):
+        ids = ",".join(str(item) for item in asset_ids[k:k + DELETE_BATCH])
+        request(
+            "DELETE",
+            ENV["supabase_url"] + ASSETS + f"?asset_id=in.({ids})",
+            headers=HEADERS
+        )
+        count_rows("delete", len(asset_ids[k:k + DELETE_BATCH]))
+
+def init_state():
+    db = open_state(ENV.get("state", "state.db"))
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS nftv_fingerprints "
+        "(asset_id INTEGER PRIMARY KEY, template_id INTEGER NOT NULL, hash BLOB NOT NULL)"
+    )
+    db.execute("CREATE INDEX IF NOT EXISTS nftv_fingerprints_template ON nftv_fingerprints (template_id)")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS nftv_senders "
+        "(asset_id INTEGER PRIMARY KEY, transferred_at INTEGER NOT NULL, sender TEXT NOT NULL)"
+    )
+    db.commit()
+    return db
+
+class Row:
+    # Fields shared by a template are encoded once and referenced by every row
+    __slots__ = ("asset_id", "shared", "owner", "mint", "drip", "bonus", "throttle")
+
+    def __init__(self, asset_id, shared, owner, mint, drip, bonus, throttle):
+        self.asset_id = asset_id
+        self.shared = shared
+        self.owner = owner
+        self.mint = mint
+        self.drip = drip
+        self.bonus = bonus
+        self.throttle = throttle
+
+    def encode(self):
+        gross = self.drip * self.bonus
+        return ROW.format(
+            self.asset_id,
+            self.shared,
+            json.dumps(self.owner),
+            self.mint,
+            self.drip,
+            self.bonus,
+            gross,
+            self.throttle,
+            gross * self.throttle
+        ).encode()
+
+def fingerprint(body):
+    return hashlib.blake2b(body, digest_size=8).digest()
+
+def load_fingerprints(template_id):
+    with STATE_LOCK:
+        rows = STATE.execute(
+            "SELECT asset_id, hash FROM nftv_fingerprints WHERE template_id = ?",
+            (template_id,)
+        ).fetchall()
+    return dict(rows)
+
+def save_fingerprints(template_id, hashes):
+    with STATE_LOCK:
+        STATE.executemany(
+            "INSERT OR REPLACE INTO nftv_fingerprints (asset_id, template_id, hash) VALUES (?, ?, ?)",
+            [(asset_id, template_id, digest) for asset_id, digest in hashes.items()]
+        )
+        STATE.commit()
+
+def drop_fingerprints(template_ids):
+    with STATE_LOCK:
+        STATE.executemany("DELETE FROM nftv_fingerprints WHERE template_id = ?", [(item,) for item in template_ids])
+        STATE.commit()
+
+def forget_fingerprints(asset_ids):
+    with STATE_LOCK:
+        STATE.executemany("DELETE FROM nftv_fingerprints WHERE asset_id = ?", [(item,) for item in asset_ids])
+        STATE.commit()
+
+def transfer_point(asset):
+    return (int(asset.get("transferred_at_block") or 0), int(asset.get("transferred_at_time") or 0))
+
+def load_senders(assets):
+    ids = list(assets)
+    with STATE_LOCK:
+        rows = STATE.execute(
+            f"SELECT asset_id, transferred_at, sender FROM nftv_senders WHERE asset_id IN ({','.join('?' * len(ids))})",
+            ids
+        ).fetchall()
+    # A cached sender is only valid while the asset has not moved since
+    return {asset_id: sender for asset_id, block, sender in rows if block > 0 and block == assets[asset_id][0]}
+
+def save_senders(assets, senders):
+    with STATE_LOCK:
+        STATE.executemany(
+            "INSERT OR REPLACE INTO nftv_senders (asset_id, transferred_at, sender) VALUES (?, ?, ?)",
+            [(asset_id, assets[asset_id][0], sender) for asset_id, sender in senders.items()]
+        )
+        STATE.commit()
+
+def resolve_senders(assets):
+    senders = load_senders(assets)
+    misses = [asset_id for asset_id in assets if asset_id not in senders]
+    batches = [
+        {asset_id: assets[asset_id] for asset_id in misses[k:k + SENDER_BATCH]}
+        for k in range(0, len(misses), SENDER_BATCH)
+    ]
+    futures = [SENDERS.submit(get_senders, batch) for batch in batches]
+    errors = []
+    for batch, future in zip(batches, futures):
         try:
-            r = requests.post(
-                ENV["supabase_url"] + "/rpc/" + TEMPLATES,
-                headers=HEADERS,
-                json=params,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            if len(r.json()) < 1:
-                return output
-            output += r.json()
-            params["off"] += 1000
+            found = future.result()
         except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+            errors.append((batch, err))
+            continue
+        save_senders(batch, found)
+        senders.update(found)
+    return senders, errors
+
+def write(body, pages):
+    upload_assets(body)
+    count_rows("upsert", sum(len(hashes) for tid, hashes in pages))
+    for tid, hashes in pages:
+        save_fingerprints(tid, hashes)
+
+def write_failed(err, body, pages):
+    tids = ",".join(sorted({str(tid) for tid, hashes in pages}))
+    rows = sum(len(hashes) for tid, hashes in pages)
+    msg = f"{tids}: Assets upload failed for {rows} rows, {str(err)}"
+    logger.exception(msg, exc_info=err)
+    post_alert("fail", NAME, msg)
+
+def close_writes():
+    global BUFFER, WRITER
+    failed = 0
+    if BUFFER is not None:
+        BUFFER.close()
+        BUFFER = None
+    if WRITER is not None:
+        failed = WRITER.close()
+        WRITER = None
+    return failed
 
-def del_assets(template_id):
-    retry_count = 0
-    while retry_count < RETRY:
+def close_all():
+    # Also runs after a failed run, under host.py nothing may outlive it
+    global SENDERS, STATE
+    close_writes()
+    if SENDERS is not None:
+        SENDERS.shutdown()
+        SENDERS = None
+    if STATE is not None:
+        STATE.close()
+        STATE = None
+
+def crawl(i):
+    status = 0
+    complete = True
+    seen = set()
+    page = 1
+    col = i["collection"]
+    tid = i["template_id"]
+    base = i["drip_amount"]
+    known = {}
+    shared = {}
+    uploaded = 0
+    if ENV.get("incremental", False):
+        known = load_fingerprints(tid)
+
+    pages = prefetch(paginate(lambda bound, limit: get_assets(col, tid, bound, limit), fields=ASSET_FIELDS))
+    while True:
         try:
-            r = requests.delete(
-                ENV["supabase_url"] + ASSETS + f"?template_id=eq.{template_id}",
-                headers=HEADERS,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            break
+            data = next(pages, None)
+            if data is None:
+                break
         except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
+            msg = f"{col} - {tid} - {page}: Fetching assets failed, {str(err)}"
+            logger.exception(msg, exc_info=err)
+            post_alert("fail", NAME, msg)
+            status = 1
+            complete = False
+            break
+
+        custodial = {int(j["asset_id"]): transfer_point(j) for j in data if j["owner"] in ENV["custodial"]}
+        senders = {}
+        failed = set()
+        if len(custodial) > 0:
+            senders, errors = resolve_senders(custodial)
+            for batch, err in errors:
+                msg = f"{col} - {tid} - {page}: Fetching senders for {len(batch)} assets failed, {str(err)}"
+                logger.exception(msg, exc_info=err)
+                post_alert("fail", NAME, msg)
+                failed.update(batch)
+                status = 1
+
+        output = []
+        for j in data:
+            mint = int(j["template_mint"])
+            asset_id = int(j["asset_id"])
+            owner = j["owner"]
+            logger.debug("%s - %s: %s, %s", col, tid, asset_id, owner)
+
+            # Burnt assets are left out and removed by the reconciliation below
+            if owner == None:
+                continue
+            seen.add(asset_id)
+
+            # Custom handling for custodial staking
+            if owner in ENV["custodial"]:
+                if asset_id in failed:
+                    continue
+                if asset_id not in senders:
+                    msg = f"{col} - {tid}: Fetching sender for {asset_id} failed, no transfer found"
+                    logger.error(msg)
+                    post_alert("fail", NAME, msg)
+                    status = 1
+                    continue
+                owner = senders[asset_id]
+                logger.debug("Custodial staked, original owner: %s", owner)
+
+            if owner in block:
+                logger.debug("Blocked account: %s", owner)
+                drip = 0
             else:
-                sleep(SLEEP)
+                drip = base
+
+            if i["ownership"] and "data" in j["mutable_data"] and j["mutable_data"]["data"] != "":
+                recipient = json.loads(j["mutable_data"]["data"])
+                if len(recipient) > 0 and recipient[0]["recipient"] != owner:
+                    drip = 0
+
+            bonus = 1
+            if j["template_mint"] in i["mint_bonuses"]:
+                bonus = i["mint_bonuses"][j["template_mint"]]
+            throttle = 1
+            if i["throttle"]:
+                throttle = THROTTLE
+
+            key = (j["data"]["name"], j["template"]["max_supply"], j["template"]["issued_supply"])
+            if key not in shared:
+                shared[key] = SHARED.format(json.dumps(col), tid, json.dumps(key[0]), int(key[1]), int(key[2]))
+            output.append(Row(asset_id, shared[key], owner, mint, drip, bonus, throttle))
+
+        # Only send rows that differ from the last successful upload
+        hashes = {}
+        changed = []
+        for row in output:
+            body = row.encode()
+            digest = fingerprint(body)
+            if known.get(row.asset_id) != digest:
+                hashes[row.asset_id] = digest
+                changed.append((row.asset_id, body))
+
+        if len(changed) > 0:
+            BUFFER.add_encoded(changed, (tid, hashes))
+        uploaded += len(changed)
 
-def del_burnt(asset_id):
-    retry_count = 0
-    while retry_count < RETRY:
+        page += 1
+
+    # Rows stored for this template but no longer listed are burnt or stale,
+    # only trust the difference when every page was fetched
+    stale = []
+    if complete:
         try:
-            r = requests.delete(
-                ENV["supabase_url"] + ASSETS + f"?asset_id=eq.{asset_id}",
-                headers=HEADERS,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            break
+            stale = sorted(get_stored(tid) - seen)
         except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+            msg = f"{col} - {tid}: Fetching stored assets failed, {str(err)}"
+            logger.exception(msg, exc_info=err)
+            post_alert("fail", NAME, msg)
+            status = 1
+    logger.info(f"{col} - {tid}: {len(seen)} assets, {uploaded} uploaded, {len(stale)} stale")
+    return status, stale
 
 try:
     logger = setup_logger(NAME)
     try:
-        me = singleton.SingleInstance()
+        me = single_instance()
     except:
         msg = "Already running, exiting"
         logger.error(msg)
@@ -210,136 +433,61 @@ try:
 
     status = 0
     start = datetime.now()
-    with open("config.json") as file:
-        ENV = json.load(file)
+    ENV = load_config()
+    configure_http(pool_size=max(POOL_SIZE, ENV.get("crawl_workers", WORKERS)), http2=ENV.get("http2", False))
     HEADERS["apikey"] = ENV["supabase_key"]
     HEADERS["Authorization"] += ENV["supabase_key"]
-    block = get_block()
+    STATE = init_state()
+    SENDERS = ThreadPoolExecutor(max_workers=ENV.get("sender_workers", SENDER_WORKERS))
+    WRITER = Writer(write, write_failed, workers=ENV.get("upload_workers", UPLOAD_WORKERS))
+    BUFFER = Buffer(WRITER.put)
+    block = {item["collection"] for item in get_block()}
     rates = get_rates()
     config = get_config()
-    templates = get_templates()
+    templates = rpc_rows(get_templates)
     THROTTLE = float([item["value"] for item in config if item["config"] == "throttle"][0])
 
-    for i in templates:
-        found = [item for item in rates if item["template_id"] == i["template_id"]]
-        if len(found) < 1:
-            try:
-                del_assets(i["template_id"])
-                logger.info(f"{i['template_id']}: Old template deleted")
-            except Exception as err:
-                msg = f"{i['template_id']}: Deleting old template failed, {str(err)}"
-                logger.exception(msg, exc_info=err)
-                post_alert("fail", NAME, msg)
-                status = 1
-                continue
-
-    for i in rates:
-        page = 1
-        col = i["collection"]
-        tid = i["template_id"]
-        base = i["drip_amount"]
-
-        while True:
-            try:
-                data = get_assets(col, tid, page)
-                if len(data) < 1:
-                    break
-            except Exception as err:
-                msg = f"{col} - {tid} - {page}: Fetching assets failed, {str(err)}"
-                logger.exception(msg, exc_info=err)
-                post_alert("fail", NAME, msg)
-                status = 1
-                break
+    rated = {item["template_id"] for item in rates}
+    removed = [i["template_id"] for i in templates if i["template_id"] not in rated]
+    if len(removed) > 0:
+        try:
+            del_assets(removed)
+            drop_fingerprints(removed)
+            logger.info(f"{','.join(str(item) for item in removed)}: Old templates deleted")
+        except Exception as err:
+            msg = f"{','.join(str(item) for item in removed)}: Deleting old templates failed, {str(err)}"
+            logger.exception(msg, exc_info=err)
+            post_alert("fail", NAME, msg)
+            status = 1
 
-            output = []
-            for j in data:
-                mint = int(j["template_mint"])
-                asset_id = int(j["asset_id"])
-                name = j["data"]["name"]
-                owner = j["owner"]
-                max_supply = int(j["template"]["max_supply"])
-                issued = int(j["template"]["issued_supply"])
-                logger.info(f"{col} - {tid}: {asset_id}, {owner}")
-
-                """
-                if owner == None:
-                    try:
-                        del_burnt(asset_id)
-                        logger.info(f"{col} - {tid}: Burnt {asset_id} deleted")
-                        continue
-                    except Exception as err:
-                        msg = f"{col} - {tid}: Failed to delete burnt {asset_id}, {str(err)}"
-                        logger.exception(msg, exc_info=err)
-                        post_alert("fail", NAME, msg)
-                        continue
-                """
-
-                # Custom handling for custodial staking
-                if owner in ENV["custodial"]:
-                    try:
-                        owner = get_sender(asset_id)
-                        logger.info(f"Custodial staked, original owner: {owner}")
-                    except Exception as err:
-                        msg = f"{col} - {tid}: Fetching sender for {asset_id} failed, {str(err)}"
-                        logger.exception(msg, exc_info=err)
-                        post_alert("fail", NAME, msg)
-                        status = 1
-                        continue
-
-                bl_check = [item for item in block if item["collection"] == owner]
-                if len(bl_check) > 0:
-                    logger.info(f"Blocked account: {owner}")
-                    drip = 0
-                elif owner == None:
-                    drip = 0
-                else:
-                    drip = base
-
-                if i["ownership"] and "data" in j["mutable_data"] and j["mutable_data"]["data"] != "":
-                    recipient = json.loads(j["mutable_data"]["data"])
-                    if len(recipient) > 0 and recipient[0]["recipient"] != owner:
-                        drip = 0
-
-                bonus = 1
-                if j["template_mint"] in i["mint_bonuses"]:
-                    bonus = i["mint_bonuses"][j["template_mint"]]
-                throttle = 1
-                if i["throttle"]:
-                    throttle = THROTTLE
-
-                gross = drip * bonus
-                net = gross * throttle
-
-                output.append({
-                    "asset_id": asset_id,
-                    "collection": col,
-                    "template_id": tid,
-                    "name": name,
-                    "owner": owner,
-                    "max_supply": max_supply,
-                    "issued_supply": issued,
-                    "mint_number": mint,
-                    "drip_amount": drip,
-                    "mint_number_bonus": bonus,
-                    "gross_drip_amount": gross,
-                    "throttle_tax_reducer": throttle,
-                    "net_drip_amount": net
-                })
-
-            try:
-                upload_assets(output)
-            except Exception as err:
-                msg = f"{col} - {tid} - {page}: Assets upload failed, {str(err)}"
-                logger.exception(msg, exc_info=err)
-                post_alert("fail", NAME, msg)
-                status = 1
+    stale = []
+    with ThreadPoolExecutor(max_workers=ENV.get("crawl_workers", WORKERS)) as executor:
+        for result, found in executor.map(crawl, rates):
+            status = max(status, result)
+            stale += found
+    if close_writes() > 0:
+        status = 1
 
-            page += 1
+    if len(stale) > 0:
+        try:
+            del_stale(stale)
+            forget_fingerprints(stale)
+            logger.info(f"{len(stale)} stale assets deleted")
+        except Exception as err:
+            msg = f"Deleting {len(stale)} stale assets failed, {str(err)}"
+            logger.exception(msg, exc_info=err)
+            post_alert("fail", NAME, msg)
+            status = 1
+    close_all()
     end = datetime.now()
     logger.info(end - start)
+    write_metrics(NAME, status)
     exit(status)
 except Exception as err:
     msg = f"Main loop failed, {str(err)}"
     logger.exception(msg, exc_info=err)
     post_alert("fail", NAME, msg)
+    write_metrics(NAME, 1)
     exit(1)
+finally:
+    close_all()
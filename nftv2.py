@@ -1,22 +1,18 @@
 #!/usr/bin/python3
 import os
-from time import sleep
 from datetime import datetime
 import copy
 import decimal
 import json
+import threading
 
-import requests
-from eosapi import EosApi
-from tendo import singleton
-
-from common import post_alert, setup_logger
+from chain import MAX_ACTIONS, Packer, error_message, expired, get_chain, rejected, transaction_id
+from common import configure_http, count_rows, load_config, loads, open_state, post_alert, request, rpc_rows, setup_logger, single_instance, write_metrics
 
 
 NAME = os.path.splitext(os.path.basename(__file__))[0]
 ENV = {}
 SKIP = []
-RPC = "https://{}"
 HEADERS = {
     "apikey": "",
     "Authorization": "Bearer ",
@@ -48,153 +44,250 @@ CONFIG = "drip_config"
 WALLETS = "get_wallets"
 DRIP = "get_drip"
 DRIPS = "get_all_drip"
-RETRY = 3
-SLEEP = 1
 LIMIT = 10
-TIMEOUT = 60
+WINDOW = 4
+STATE = None
+STATE_LOCK = threading.Lock()
+RUN = None
+PACKER = None
+OPEN = ("planned", "submitted", "confirmed")
 
 def get_config():
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                ENV["supabase_url"] + CONFIG + "?select=*",
-                headers=HEADERS,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    r = request(
+        "GET",
+        ENV["supabase_url"] + CONFIG + "?select=config,value",
+        headers=HEADERS
+    )
+    return loads(r.content)
 
 def upload_log(data):
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.post(
-                ENV["supabase_url"] + LOG,
-                headers=HEADERS,
-                json=data,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            break
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    request(
+        "POST",
+        ENV["supabase_url"] + LOG,
+        headers=HEADERS,
+        json=data
+    )
+    count_rows("upsert", len(data))
 
-def get_wallets():
-    retry_count = 0
-    output = []
-    params = {"lim": 1000, "off": 0}
-    while True:
-        try:
-            r = requests.post(
-                ENV["supabase_url"] + "rpc/" + WALLETS,
-                headers=HEADERS,
-                json=params,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            if len(r.json()) < 1:
-                return output
-            output += [item["wallet"] for item in r.json()]
-            params["off"] += 1000
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+def get_wallets(offset, limit):
+    return request(
+        "POST",
+        ENV["supabase_url"] + "rpc/" + WALLETS,
+        headers=HEADERS,
+        json={"lim": limit, "off": offset}
+    )
 
 def get_drip(wallet):
-    retry_count = 0
     params = {"wallet": wallet}
-    while True:
-        try:
-            r = requests.post(
-                ENV["supabase_url"] + "rpc/" + DRIP,
-                headers=HEADERS,
-                json=params,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.text
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    r = request(
+        "POST",
+        ENV["supabase_url"] + "rpc/" + DRIP,
+        headers=HEADERS,
+        json=params
+    )
+    return r.text
 
-def get_drips():
-    retry_count = 0
-    output = []
-    params = {"lim": 1000, "off": 0}
-    while True:
-        try:
-            r = requests.post(
-                ENV["supabase_url"] + "rpc/" + DRIPS,
-                headers=HEADERS,
-                json=params,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            if len(r.json()) < 1:
-                return output
-            output += r.json()
-            params["off"] += 1000
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+def get_drips(offset, limit):
+    return request(
+        "POST",
+        ENV["supabase_url"] + "rpc/" + DRIPS,
+        headers=HEADERS,
+        json={"lim": limit, "off": offset}
+    )
+
+def get_dist(offset, limit):
+    return request(
+        "POST",
+        ENV["supabase2_url"] + "rpc/" + WALLETS,
+        headers=HEADERS2,
+        json={"lim": limit, "off": offset}
+    )
 
-def get_dist():
-    retry_count = 0
+def init_state():
+    db = open_state(ENV.get("state", "state.db"))
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS drip_runs "
+        "(run INTEGER PRIMARY KEY AUTOINCREMENT, started INTEGER NOT NULL, finished INTEGER)"
+    )
+    # A transfer moves planned -> submitted (signed copy on disk) -> confirmed
+    # (node has it) -> logged, or ends as failed (rejected or expired unexecuted)
+    # or unknown (expired and the history cannot tell)
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS drip_ledger "
+        "(run INTEGER NOT NULL, wallet TEXT NOT NULL, quantity TEXT NOT NULL, state TEXT NOT NULL, "
+        "txn_id TEXT, trx TEXT, PRIMARY KEY (run, wallet))"
+    )
+    db.commit()
+    return db
+
+def load_run():
+    with STATE_LOCK:
+        row = STATE.execute("SELECT run FROM drip_runs WHERE finished IS NULL ORDER BY run DESC LIMIT 1").fetchone()
+    return None if row is None else row[0]
+
+def start_run(plan):
+    with STATE_LOCK:
+        run = STATE.execute("INSERT INTO drip_runs (started) VALUES (?)", (int(datetime.now().timestamp()),)).lastrowid
+        STATE.executemany(
+            "INSERT INTO drip_ledger (run, wallet, quantity, state) VALUES (?, ?, ?, 'planned')",
+            [(run, wallet, quantity) for wallet, quantity in plan.items()]
+        )
+        STATE.commit()
+    return run
+
+def load_ledger(state):
+    with STATE_LOCK:
+        return STATE.execute(
+            "SELECT wallet, quantity, txn_id, trx FROM drip_ledger WHERE run = ? AND state = ? ORDER BY rowid",
+            (RUN, state)
+        ).fetchall()
+
+def mark(state, wallets, txn_id=None, trx=None):
+    with STATE_LOCK:
+        STATE.executemany(
+            "UPDATE drip_ledger SET state = ?, txn_id = COALESCE(?, txn_id), trx = COALESCE(?, trx) WHERE run = ? AND wallet = ?",
+            [(state, txn_id, trx, RUN, wallet) for wallet in wallets]
+        )
+        STATE.commit()
+
+def finish_run():
+    with STATE_LOCK:
+        left = STATE.execute(
+            "SELECT COUNT(*) FROM drip_ledger WHERE run = ? AND state IN (?, ?, ?)",
+            (RUN, *OPEN)
+        ).fetchone()[0]
+        if left > 0:
+            return left
+        # drip_log keeps the permanent record, failed and unknown rows stay for reconciliation
+        STATE.execute("UPDATE drip_runs SET finished = ? WHERE run = ?", (int(datetime.now().timestamp()), RUN))
+        STATE.execute("DELETE FROM drip_ledger WHERE run = ? AND state = 'logged'", (RUN,))
+        STATE.commit()
+    return 0
+
+def transfer_action(wallet, quantity):
+    action = copy.deepcopy(ACTION)
+    action["account"] = ENV["token_contract"]
+    action["authorization"][0]["actor"] = ENV["acc"]
+    action["data"]["from"] = ENV["acc"]
+    action["data"]["to"] = wallet
+    action["data"]["quantity"] = quantity
+    return action
+
+def submit(actions):
+    body = chain.packed(chain.build(actions))
+    # The signed copy is on disk before the node sees it, a resume resends
+    # this exact transaction instead of paying again
+    mark("submitted", [j["data"]["to"] for j in actions], transaction_id(body), json.dumps(body))
+    return chain.send(body, len(actions))
+
+def log_transfers(txn_id, transfers):
+    global status
     output = []
-    params = {"lim": 1000, "off": 0}
-    while True:
-        try:
-            r = requests.post(
-                ENV["supabase2_url"] + "rpc/" + WALLETS,
-                headers=HEADERS2,
-                json=params,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            if len(r.json()) < 1:
-                return output
-            output += [item["address"] for item in r.json()]
-            params["off"] += 1000
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    for wallet, quantity in transfers:
+        logger.debug("%s: %s", wallet, quantity)
+        output.append({
+            "txn_id": txn_id,
+            "to": wallet,
+            "amount": float(quantity.split()[0]),
+            "token": ENV["token_sym"]
+        })
+    try:
+        upload_log(output)
+    except Exception as err:
+        msg = f"Failed to upload log for {','.join([wallet for wallet, quantity in transfers])} - {str(err)}"
+        logger.exception(msg, exc_info=err)
+        post_alert("fail", NAME, msg)
+        status = 1
+        return
+    mark("logged", [wallet for wallet, quantity in transfers])
+
+def transferred(txn_id, actions):
+    logger.info(f"Transferred {txn_id}: {len(actions)} transfers")
+    mark("confirmed", [j["data"]["to"] for j in actions], txn_id)
+    log_transfers(txn_id, [(j["data"]["to"], j["data"]["quantity"]) for j in actions])
+
+def transfer_failed(actions, err):
+    global status
+    wallets = [item["data"]["to"] for item in actions]
+    if rejected(err):
+        mark("failed", wallets)
+        msg = f"Transfer failed for {','.join(wallets)} - {error_message(err)}"
+    else:
+        # The node may or may not have it, the next run resends the signed copy
+        msg = f"Transfer unconfirmed for {','.join(wallets)} - {str(err)}"
+    logger.exception(msg, exc_info=err)
+    post_alert("fail", NAME, msg)
+    status = 1
 
-def transact(actions, api):
-    retry_count = 0
-    trx = {"actions": actions}
-    while True:
+def recover():
+    global status
+    batches = {}
+    for wallet, quantity, txn_id, trx in load_ledger("submitted"):
+        batches.setdefault((txn_id, trx), []).append(wallet)
+    for (txn_id, trx), wallets in batches.items():
+        body = json.loads(trx)
         try:
-            r = api.push_transaction(trx)
-            return r["transaction_id"]
+            # A duplicate means the first copy went through and counts as confirmed
+            chain.send(body, len(wallets), resend=True)
         except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
+            if expired(err):
+                # Too late to resend, the history decides whether the first copy landed
+                found = chain.lookup(body)
+                if found:
+                    logger.info(f"Found {txn_id} in history: {len(wallets)} transfers")
+                    mark("confirmed", wallets)
+                    continue
+                if found is None:
+                    mark("unknown", wallets)
+                    msg = f"Transaction {txn_id} expired and the history cannot tell, check {','.join(wallets)} by hand"
+                else:
+                    mark("failed", wallets)
+                    msg = f"Transaction {txn_id} expired without executing, {','.join(wallets)} were not paid"
+            elif rejected(err):
+                mark("failed", wallets)
+                msg = f"Transfer failed for {','.join(wallets)} - {error_message(err)}"
             else:
-                sleep(SLEEP)
+                msg = f"Resending {txn_id} failed, {str(err)}"
+            logger.exception(msg, exc_info=err)
+            post_alert("fail", NAME, msg)
+            status = 1
+            continue
+        logger.info(f"Confirmed {txn_id}: {len(wallets)} transfers")
+        mark("confirmed", wallets)
+
+    batches = {}
+    for wallet, quantity, txn_id, trx in load_ledger("confirmed"):
+        batches.setdefault(txn_id, []).append((wallet, quantity))
+    for txn_id, transfers in batches.items():
+        log_transfers(txn_id, transfers)
+
+def plan_run():
+    config = get_config()
+    mode = [item["value"] for item in config if item["config"] == "vip_only"][0]
+    # The full list is read before the first transfer, a fetch failure halfway
+    # must not leave a partial payout behind
+    if mode == "true":
+        wallets = [item["address"] for item in rpc_rows(get_dist)]
+        logger.info("Wallet count: " + str(len(wallets)))
+        logger.debug("%s", wallets)
+    else:
+        wallets = [item["wallet"] for item in rpc_rows(get_wallets)]
+
+    drips = {item["wallet"]: item["drip"] for item in rpc_rows(get_drips)}
+    plan = {}
+    for i in wallets:
+        if i in SKIP:
+            logger.debug("%s: Skipped", i)
+            continue
+
+        drip = drips.get(i, 0)
+
+        if drip != 0:
+            amount = float(drip)
+            plan[i] = formatToken(amount, ENV["token_precision"]) + " " + ENV["token_sym"]
+        else:
+            logger.debug("%s: No drip", i)
+    return plan
 
 def formatToken(amount, precision):
     rounded_num = decimal.Decimal(str(amount)).quantize(
@@ -204,7 +297,7 @@ def formatToken(amount, precision):
 try:
     logger = setup_logger(NAME)
     try:
-        me = singleton.SingleInstance()
+        me = single_instance()
     except:
         msg = "Already running, exiting"
         logger.error(msg)
@@ -213,96 +306,63 @@ try:
 
     status = 0
     start = datetime.now()
-    with open("config.json") as file:
-        ENV = json.load(file)
+    ENV = load_config()
     with open("skip.json") as file:
-        SKIP = json.load(file)
+        SKIP = set(json.load(file))
+    configure_http(http2=ENV.get("http2", False))
     HEADERS["apikey"] = ENV["supabase_key"]
     HEADERS["Authorization"] += ENV["supabase_key"]
     HEADERS2["apikey"] = ENV["supabase2_key"]
     HEADERS2["Authorization"] += ENV["supabase2_key"]
-    api = EosApi(rpc_host=RPC.format(ENV["rpc"]))
-    api.import_key(ENV["acc"], ENV["acc_key"], "active")
-    api.session.headers["apikey"] = ENV["rpc_key"]
-    config = get_config()
-    mode = [item["value"] for item in config if item["config"] == "vip_only"][0]
-    if mode == "true":
-        wallets = get_dist()
-        logger.info("Wallet count: " + str(len(wallets)))
-        logger.info(wallets)
+    chain = get_chain(ENV)
+    STATE = init_state()
+    RUN = load_run()
+    if RUN is not None:
+        # An interrupted run pays out its own plan, confirmed wallets are never paid again
+        logger.info(f"Resuming run {RUN}")
+        recover()
     else:
-        wallets = get_wallets()
-
-    try:
-        drips = get_drips()
-    except Exception as err:
-        msg = f"Failed to get drips, {str(err)}"
-        logger.exception(msg, exc_info=err)
-        post_alert("fail", NAME, msg)
-        exit(1)
-
-    actions = []
-    for index, i in enumerate(wallets):
-        if i in SKIP:
-            logger.info(f"{i}: Skipped")
-            continue
-
-        found = [item["drip"] for item in drips if item["wallet"] == i]
-        if len(found) == 0:
-            drip = 0
-        else:
-            drip = found[0]
-
-        if drip != 0:
-            amount = float(drip)
-            action = copy.deepcopy(ACTION)
-            action["account"] = ENV["token_contract"]
-            action["authorization"][0]["actor"] = ENV["acc"]
-            action["data"]["from"] = ENV["acc"]
-            action["data"]["to"] = i
-            action["data"]["quantity"] = formatToken(amount, ENV["token_precision"]) + " " + ENV["token_sym"]
-            actions.append(action)
-        else:
-            logger.info(f"{i}: No drip")
+        try:
+            plan = plan_run()
+        except Exception as err:
+            msg = f"Failed to plan the payout, {str(err)}"
+            logger.exception(msg, exc_info=err)
+            post_alert("fail", NAME, msg)
+            write_metrics(NAME, 1)
+            exit(1)
+        RUN = start_run(plan)
+        logger.info(f"Run {RUN}: {len(plan)} transfers planned")
 
-        if len(actions) >= LIMIT or (index == len(wallets) - 1 and len(actions) > 0):
-            try:
-                txn_id = transact(actions, api)
-            except Exception as err:
-                try:
-                    error = json.loads(str(err).replace("transaction error: ", ""))
-                    msg = f"Transfer failed for {','.join([item['data']['to'] for item in actions])} - {error['error']['details'][0]['message']}"
-                except:
-                    msg = f"Transfer failed for {','.join([item['data']['to'] for item in actions])} - {str(err)}"
-                logger.exception(msg, exc_info=err)
-                post_alert("fail", NAME, msg)
-                actions = []
-                status = 1
-                continue
-            logger.info(f"Transferred {txn_id}")
-            output = []
-            for j in actions:
-                logger.info(f"{j['data']['to']}: {j['data']['quantity']}")
-                output.append({
-                    "txn_id": txn_id,
-                    "to": j["data"]["to"],
-                    "amount": float(j["data"]["quantity"].split()[0]),
-                    "token": ENV["token_sym"]
-                })
-            try:
-                upload_log(output)
-            except Exception as err:
-                msg = f"Failed to upload log for {','.join([item['data']['to'] for item in actions])} - {str(err)}"
-                logger.exception(msg, exc_info=err)
-                post_alert("fail", NAME, msg)
-                status = 1
-            actions = []
+    PACKER = Packer(
+        submit,
+        transferred,
+        transfer_failed,
+        size=LIMIT,
+        max_actions=ENV.get("max_actions", MAX_ACTIONS),
+        limits=chain.limits(),
+        window=ENV.get("trx_window", WINDOW)
+    )
+    for wallet, quantity, txn_id, trx in load_ledger("planned"):
+        action = transfer_action(wallet, quantity)
+        PACKER.add(action, action)
+    PACKER.flush()
+    left = finish_run()
+    if left > 0:
+        logger.warning(f"Run {RUN}: {left} transfers left for the next run")
 
     end = datetime.now()
     logger.info(end - start)
+    write_metrics(NAME, status)
     exit(status)
 except Exception as err:
     msg = f"Main loop failed, {str(err)}"
     logger.exception(msg, exc_info=err)
     post_alert("fail", NAME, msg)
+    write_metrics(NAME, 1)
     exit(status)
+finally:
+    # Also runs after a failed run, under host.py nothing may outlive it
+    if PACKER is not None:
+        PACKER.close()
+    if STATE is not None:
+        STATE.close()
@@ -1,115 +1,89 @@
 #!/usr/bin/python3
 import os
-from time import sleep
 from datetime import datetime
-import json
 
-import requests
-from tendo import singleton
-
-from common import post_alert, setup_logger
+from common import Buffer, Writer, base_url, configure_http, count_rows, json_body, load_config, paginate, post_alert, prefetch, projection, request, setup_logger, single_instance, write_metrics
 
 NAME = os.path.splitext(os.path.basename(__file__))[0]
 ENV = {}
-AA = "https://{}/atomicassets/v1/assets?template_id=730860&page={}&limit=100&order=desc&sort=asset_id"
+AA = "{}/atomicassets/v1/assets?template_id=730860&lower_bound={}&limit={}&order=asc&sort=asset_id"
 HEADERS = {
     "apikey": "",
     "Authorization": "Bearer ",
-    "Prefer": "resolution=merge-duplicates"
+    "Prefer": "resolution=merge-duplicates,return=minimal"
 }
 ASSETS = "pawsome"
 CONFIG = "drip_config"
-RETRY = 3
-SLEEP = 1
-TIMEOUT = 60
 
-def get_assets(page):
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                AA.format(ENV["aa"], page),
-                headers={"apikey": ENV["aa_key"]},
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()["data"]
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+def get_assets(bound, limit):
+    return request(
+        "GET",
+        AA.format(base_url(ENV["aa"]), bound, limit),
+        headers={"apikey": ENV["aa_key"]}
+    )
 
-def upload_assets(data):
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.post(
-                ENV["supabase_url"] + ASSETS,
-                headers=HEADERS,
-                json=data,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            break
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+def upload_assets(body):
+    data, headers = json_body(body, ENV.get("gzip", False))
+    request(
+        "POST",
+        ENV["supabase_url"] + ASSETS,
+        headers={**HEADERS, **headers},
+        data=data
+    )
+
+def upload_failed(err, body, pages):
+    pages = [page for page, rows in pages]
+    msg = f"Pages {min(pages)}-{max(pages)}: Assets upload failed, {str(err)}"
+    logger.exception(msg, exc_info=err)
+    post_alert("fail", NAME, msg)
+
+def upload_pages(body, pages):
+    upload_assets(body)
+    count_rows("upsert", sum(rows for page, rows in pages))
 
 def update_timestamp():
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            
-            r = requests.post(
-                ENV["supabase_url"] + CONFIG,
-                headers=HEADERS,
-                json=[{
-                    "config": "pawsome_update",
-                    "value": f"{int(datetime.now().timestamp())}"
-                }],
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            break
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    request(
+        "POST",
+        ENV["supabase_url"] + CONFIG,
+        headers=HEADERS,
+        json=[{
+            "config": "pawsome_update",
+            "value": f"{int(datetime.now().timestamp())}"
+        }]
+    )
 
 try:
     logger = setup_logger(NAME)
     try:
-        me = singleton.SingleInstance()
+        me = single_instance()
     except:
         msg = "Already running, exiting"
         logger.error(msg)
         post_alert("fail", NAME, msg)
         exit()
 
+    status = 0
     start = datetime.now()
-    with open("config.json") as file:
-        ENV = json.load(file)
+    ENV = load_config()
+    configure_http(http2=ENV.get("http2", False))
     HEADERS["apikey"] = ENV["supabase_key"]
     HEADERS["Authorization"] += ENV["supabase_key"]
 
     page = 1
+    pages = prefetch(paginate(get_assets, fields=projection("asset_id", "owner")))
+    writer = Writer(upload_pages, upload_failed)
+    buffer = Buffer(writer.put)
     while True:
         try:
-            logger.info(f"Fetching page {page}")
-            data = get_assets(page)
-            if len(data) < 1:
+            logger.debug("Fetching page %s", page)
+            data = next(pages, None)
+            if data is None:
                 break
         except Exception as err:
             msg = f"Page {page}: Fetching assets failed, {str(err)}"
             logger.exception(msg, exc_info=err)
             post_alert("fail", NAME, msg)
+            status = 1
             break
 
         output = []
@@ -118,18 +92,20 @@ try:
                 "asset_id": int(i["asset_id"]),
                 "owner": i["owner"]
             })
-        try:
-            upload_assets(output)
-        except Exception as err:
-            msg = f"Page {page}: Assets upload failed, {str(err)}"
-            logger.exception(msg, exc_info=err)
-            post_alert("fail", NAME, msg)
+        buffer.add(output, (page, len(output)))
 
         page += 1
+    buffer.close()
+    if writer.close() > 0:
+        status = 1
     update_timestamp()
     end = datetime.now()
     logger.info(end - start)
+    write_metrics(NAME, status)
+    exit(status)
 except Exception as err:
     msg = f"Main loop failed, {str(err)}"
     logger.exception(msg, exc_info=err)
     post_alert("fail", NAME, msg)
+    write_metrics(NAME, 1)
+    exit(1)
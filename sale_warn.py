@@ -1,21 +1,30 @@
 #!/usr/bin/python3
 import os
-from time import sleep
+from time import monotonic, sleep
 from datetime import datetime
+import argparse
 import copy
-import json
 
-import requests
-from eosapi import EosApi
-from tendo import singleton
-
-from common import post_alert, setup_logger
+from chain import MAX_ACTIONS, Packer, error_message, get_chain
+from common import base_url, configure_http, load_config, loads, paginate, post_alert, project, projection, request, setup_logger, single_instance, write_metrics
 
 
 NAME = os.path.splitext(os.path.basename(__file__))[0]
 ENV = {}
-RPC = "https://{}"
-AH = "https://{}/atomicmarket/v1/assets?collection_name={}&template_id={}&page={}&limit=1000&order=asc&sort=asset_id"
+AH = "{}/atomicassets/v1/assets?collection_name={}&template_id={}&lower_bound={}&limit={}&order=asc&sort=asset_id"
+ACTIVE = "{}/atomicmarket/v1/sales?collection_name={}&state=1&lower_bound={}&limit={}&order=asc&sort=sale_id"
+ACTIVE_BY_ID = "{}/atomicmarket/v1/sales?asset_id={}&state=1&page={}&limit=100"
+SALES = "{}/atomicmarket/v1/sales?collection_name={}&sort=updated&order=desc&page={}&limit=100"
+BY_ID = "{}/atomicassets/v1/assets?ids={}&limit={}"
+ASSET_FIELDS = projection(
+    "asset_id",
+    "owner",
+    "data.name",
+    "collection.collection_name",
+    "template.template_id",
+    "mutable_data"
+)
+SALE_FIELDS = projection("sale_id", "updated_at_time", "assets.asset_id", "assets.template.template_id")
 HEADERS = {
     "apikey": "",
     "Authorization": "Bearer ",
@@ -38,92 +47,155 @@ ACTION = {
     }
 }
 CONFIG = "sale_warning_data"
-RETRY = 3
-SLEEP = 1
-TIMEOUT = 60
+LIMIT = 5
+POLL = 5
+RELOAD = 300
 
 def get_config():
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                ENV["supabase_url"] + CONFIG + "?select=*",
-                headers=HEADERS,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    r = request(
+        "GET",
+        ENV["supabase_url"] + CONFIG + "?select=collection,template_id,normal,warning",
+        headers=HEADERS
+    )
+    return loads(r.content)
 
-def get_assets(collection, template_id, page):
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                AH.format(ENV["aa"], collection, template_id, page),
-                headers={"apikey": ENV["aa_key"]},
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()["data"]
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+def get_assets(collection, template_id, bound, limit):
+    return request(
+        "GET",
+        AH.format(base_url(ENV["aa"]), collection, template_id, bound, limit),
+        headers={"apikey": ENV["aa_key"]}
+    )
+
+def get_active(collection, bound, limit):
+    return request(
+        "GET",
+        ACTIVE.format(base_url(ENV["aa"]), collection, bound, limit),
+        headers={"apikey": ENV["aa_key"]}
+    )
+
+def get_active_by_id(ids, page):
+    r = request(
+        "GET",
+        ACTIVE_BY_ID.format(base_url(ENV["aa"]), ",".join(str(item) for item in ids), page),
+        headers={"apikey": ENV["aa_key"]}
+    )
+    return project(loads(r.content)["data"], SALE_FIELDS)
 
-def transact(actions, api):
-    retry_count = 0
-    trx = {"actions": actions}
+def get_by_id(ids):
+    r = request(
+        "GET",
+        BY_ID.format(base_url(ENV["aa"]), ",".join(str(item) for item in ids), len(ids)),
+        headers={"apikey": ENV["aa_key"]}
+    )
+    return project(loads(r.content)["data"], ASSET_FIELDS)
+
+def get_sales(collection, page):
+    r = request(
+        "GET",
+        SALES.format(base_url(ENV["aa"]), collection, page),
+        headers={"apikey": ENV["aa_key"]}
+    )
+    return project(loads(r.content)["data"], SALE_FIELDS)
+
+def updated(txn_id, items):
+    logger.info(f"Updated {txn_id}: {','.join([str(asset_id) for asset_id, name in items])}")
+
+def update_failed(items, err):
+    for asset_id, name in items:
+        msg = f"Set image failed for {asset_id}, {name} - {error_message(err)}"
+        logger.exception(msg, exc_info=err)
+        post_alert("fail", NAME, msg)
+
+def listed_sales(sales):
+    return {int(asset["asset_id"]) for sale in sales for asset in sale["assets"]}
+
+def get_listed(collection):
+    listed = set()
+    for data in paginate(lambda bound, limit: get_active(collection, bound, limit), key="sale_id", limit=1000, fields=SALE_FIELDS):
+        listed |= listed_sales(data)
+    return listed
+
+def get_listed_by_id(ids):
+    listed = set()
+    page = 1
     while True:
-        try:
-            r = api.push_transaction(trx)
-            return r["transaction_id"]
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
+        data = get_active_by_id(ids, page)
+        listed |= listed_sales(data)
+        if len(data) < 100:
+            return listed
+        page += 1
+
+def check(j, listed, normal, warning):
+    asset_id = int(j["asset_id"])
+    name = j["data"]["name"]
+    owner = j["owner"]
+
+    logger.debug("%s - %s - %s: %s, %s", j["collection"]["collection_name"], j["template"]["template_id"], name, asset_id, owner)
+
+    change = False
+    img = ""
+    if asset_id in listed:
+        if j["mutable_data"]["img"] != warning:
+            change = True
+            img = warning
+    else:
+        if j["mutable_data"]["img"] != normal:
+            change = True
+            img = normal
+
+    if change:
+        action = copy.deepcopy(ACTION)
+        action["authorization"][0]["actor"] = ENV["acc"]
+        action["data"]["authorized_editor"] = ENV["acc"]
+        action["data"]["asset_id"] = asset_id
+        action["data"]["asset_owner"] = owner
+        for k in j["mutable_data"].keys():
+            if k == "img":
+                action["data"]["new_mutable_data"].append({
+                    "key": k,
+                    "value": [
+                        "string",
+                        img
+                    ]
+                })
             else:
-                sleep(SLEEP)
+                action["data"]["new_mutable_data"].append({
+                    "key": k,
+                    "value": [
+                        "string",
+                        j["mutable_data"][k]
+                    ]
+                })
 
-try:
-    logger = setup_logger(NAME)
-    try:
-        me = singleton.SingleInstance()
-    except:
-        msg = "Already running, exiting"
-        logger.error(msg)
-        post_alert("fail", NAME, msg)
-        exit(1)
+        packer.add(action, (asset_id, name))
+    return change
 
+def scan(config):
     status = 0
-    start = datetime.now()
-    with open("config.json") as file:
-        ENV = json.load(file)
-    HEADERS["apikey"] = ENV["supabase_key"]
-    HEADERS["Authorization"] += ENV["supabase_key"]
-    api = EosApi(rpc_host=RPC.format(ENV["rpc"]))
-    api.import_key(ENV["acc"], ENV["acc_key"], "active")
-    api.session.headers["apikey"] = ENV["rpc_key"]
-    config = get_config()
-
+    listed = {}
     for i in config:
         page = 1
         col = i["collection"]
         tid = i["template_id"]
-        normal = i["normal"]
-        warning = i["warning"]
 
+        # One pass over the collection's active sales replaces per-asset sale payloads
+        if col not in listed:
+            try:
+                listed[col] = get_listed(col)
+            except Exception as err:
+                msg = f"{col}: Fetching active sales failed, {str(err)}"
+                logger.exception(msg, exc_info=err)
+                post_alert("fail", NAME, msg)
+                status = 1
+                continue
+
+        checked = 0
+        changed = 0
+        pages = paginate(lambda bound, limit: get_assets(col, tid, bound, limit), limit=1000, fields=ASSET_FIELDS)
         while True:
             try:
-                data = get_assets(col, tid, page)
-                if len(data) < 1:
+                data = next(pages, None)
+                if data is None:
                     break
             except Exception as err:
                 msg = f"{col} - {tid} - {page}: Fetching assets failed, {str(err)}"
@@ -132,68 +204,118 @@ try:
                 status = 1
                 break
 
-            output = []
             for j in data:
-                asset_id = int(j["asset_id"])
-                name = j["data"]["name"]
-                owner = j["owner"]
-
-                logger.info(f"{col} - {tid} - {name}: {asset_id}, {owner}")
-
-                change = False
-                img = ""
-                if len(j["sales"]) > 0:
-                    if j["mutable_data"]["img"] != warning:
-                        change = True
-                        img = warning
-                else:
-                    if j["mutable_data"]["img"] != normal:
-                        change = True
-                        img = normal
-
-                if change:
-                    action = copy.deepcopy(ACTION)
-                    action["authorization"][0]["actor"] = ENV["acc"]
-                    action["data"]["authorized_editor"] = ENV["acc"]
-                    action["data"]["asset_id"] = asset_id
-                    action["data"]["asset_owner"] = owner
-                    for k in j["mutable_data"].keys():
-                        if k == "img":
-                            action["data"]["new_mutable_data"].append({
-                                "key": k,
-                                "value": [
-                                    "string",
-                                    img
-                                ]
-                            })
-                        else:
-                            action["data"]["new_mutable_data"].append({
-                                "key": k,
-                                "value": [
-                                    "string",
-                                    j["mutable_data"][k]
-                                ]
-                            })
-
-                    try:
-                        txn_id = transact([action], api)
-                        logger.info(f"Updated {txn_id}")
-                    except Exception as err:
-                        try:
-                            error = json.loads(str(err).replace("transaction error: ", ""))
-                            msg = f"Set image failed for {asset_id}, {name} - {error['error']['details'][0]['message']}"
-                        except:
-                            msg = f"Set image failed for {asset_id}, {name} - {str(err)}"
-                        logger.exception(msg, exc_info=err)
-                        post_alert("fail", NAME, msg)
-                        actions = []
+                changed += check(j, listed[col], i["normal"], i["warning"])
+            checked += len(data)
 
             page += 1
+        logger.info(f"{col} - {tid}: {checked} assets checked, {changed} changed")
+    packer.flush()
+    return status
+
+def changes(collections, cursor):
+    assets = set()
+    newest = cursor
+    for col in collections:
+        page = 1
+        while True:
+            data = get_sales(col, page)
+            # Sales come newest first, stop at the first one already seen
+            fresh = [sale for sale in data if int(sale["updated_at_time"]) >= cursor]
+            for sale in fresh:
+                newest = max(newest, int(sale["updated_at_time"]))
+                for asset in sale["assets"]:
+                    if asset["template"] is not None:
+                        assets.add((col, int(asset["template"]["template_id"]), int(asset["asset_id"])))
+            if len(fresh) < len(data) or len(data) < 100:
+                break
+            page += 1
+    return assets, newest
+
+def latest(collections):
+    newest = 0
+    for col in collections:
+        data = get_sales(col, 1)
+        if len(data) > 0:
+            newest = max(newest, int(data[0]["updated_at_time"]))
+    return newest
+
+def watch(config):
+    templates = {(i["collection"], i["template_id"]): i for i in config}
+    collections = sorted({i["collection"] for i in config})
+    # Start from the newest sale before the full scan so nothing in between is missed
+    cursor = latest(collections)
+    scan(config)
+    loaded = monotonic()
+    while True:
+        started = monotonic()
+        status = 0
+        try:
+            if started - loaded > ENV.get("watch_reload", RELOAD):
+                config = get_config()
+                added = [i for i in config if (i["collection"], i["template_id"]) not in templates]
+                templates = {(i["collection"], i["template_id"]): i for i in config}
+                collections = sorted({i["collection"] for i in config})
+                status = scan(added)
+                loaded = started
+            assets, cursor = changes(collections, cursor)
+            ids = sorted(asset_id for col, tid, asset_id in assets if (col, tid) in templates)
+            for k in range(0, len(ids), 100):
+                batch = ids[k:k + 100]
+                listed = get_listed_by_id(batch)
+                for j in get_by_id(batch):
+                    key = (j["collection"]["collection_name"], int(j["template"]["template_id"]))
+                    check(j, listed, templates[key]["normal"], templates[key]["warning"])
+            packer.flush()
+        except Exception as err:
+            msg = f"Watch poll failed, {str(err)}"
+            logger.exception(msg, exc_info=err)
+            post_alert("fail", NAME, msg)
+            status = 1
+        # Alerts go out on their own thread, a poll never waits for them
+        write_metrics(NAME, status, wait=0)
+        sleep(max(0, ENV.get("watch_interval", POLL) - (monotonic() - started)))
+
+try:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--watch", action="store_true", help="keep running and react to sale changes")
+    args = parser.parse_args()
+    logger = setup_logger(NAME)
+    try:
+        me = single_instance(flavor_id="watch" if args.watch else "")
+    except:
+        msg = "Already running, exiting"
+        logger.error(msg)
+        post_alert("fail", NAME, msg)
+        exit(1)
+
+    status = 0
+    start = datetime.now()
+    ENV = load_config()
+    configure_http(http2=ENV.get("http2", False))
+    HEADERS["apikey"] = ENV["supabase_key"]
+    HEADERS["Authorization"] += ENV["supabase_key"]
+    chain = get_chain(ENV)
+    config = get_config()
+    packer = Packer(
+        chain.push,
+        updated,
+        update_failed,
+        size=LIMIT,
+        max_actions=ENV.get("max_actions", MAX_ACTIONS),
+        limits=chain.limits()
+    )
+
+    if args.watch:
+        watch(config)
+    status = scan(config)
     end = datetime.now()
     logger.info(end - start)
+    write_metrics(NAME, status)
     exit(status)
 except Exception as err:
     msg = f"Main loop failed, {str(err)}"
     logger.exception(msg, exc_info=err)
     post_alert("fail", NAME, msg)
+    write_metrics(NAME, 1)
     exit(1)
@@ -1,23 +1,22 @@
 #!/usr/bin/python3
+import argparse
 import os
-from time import sleep
 from datetime import datetime
 import copy
+import hashlib
 import json
-import random
+import secrets
+import threading
 
-import requests
-from eosapi import EosApi
-from tendo import singleton
-
-from common import post_alert, setup_logger
+from chain import MAX_ACTIONS, Packer, error_message, expired, get_chain, rejected, transaction_id
+from common import base_url, configure_http, count_rows, load_config, loads, open_state, paginate, post_alert, projection, request, setup_logger, single_instance, write_metrics
 
 
 NAME = os.path.splitext(os.path.basename(__file__))[0]
 ENV = {}
 SKIP = []
-AH = "https://{}/atomicassets/v1/assets?collection_name={}&template_id={}&page={}&limit=100&order=asc&sort=asset_id"
-RPC = "https://{}"
+AH = "{}/atomicassets/v1/assets?collection_name={}&template_id={}&lower_bound={}&limit={}&order=asc&sort=asset_id"
+ASSET_FIELDS = projection("asset_id", "owner", "mutable_data")
 HEADERS = {
     "apikey": "",
     "Authorization": "Bearer ",
@@ -45,133 +44,395 @@ ACTION = {
 }
 LOG = "ticket_log"
 BLOCK = "blocklist_main"
-RETRY = 3
-SLEEP = 1
 LIMIT = 5
-TIMEOUT = 60
+STATE = None
+STATE_LOCK = threading.Lock()
+RUN = None
+PENDING = set()
+FRONTIER = 0
+CURSOR_LOCK = threading.Lock()
 
 def get_block():
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                ENV["supabase_url"] + BLOCK + "?select=*",
-                headers=HEADERS,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    r = request(
+        "GET",
+        ENV["supabase_url"] + BLOCK + "?select=collection",
+        headers=HEADERS
+    )
+    return loads(r.content)
 
-def get_assets(collection, template_id, page):
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.get(
-                AH.format(ENV["aa"], collection, template_id, page),
-                headers={"apikey": ENV["aa_key"]},
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            return r.json()["data"]
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
+def get_assets(collection, template_id, bound, limit):
+    return request(
+        "GET",
+        AH.format(base_url(ENV["aa"]), collection, template_id, bound, limit),
+        headers={"apikey": ENV["aa_key"]}
+    )
+
+class Sampler:
+    # Alias table built once, every draw is a single lookup whatever the number of choices
+    def __init__(self, choices, weights):
+        n = len(choices)
+        total = sum(weights)
+        scaled = [weight * n / total for weight in weights]
+        small = [k for k, value in enumerate(scaled) if value < 1]
+        large = [k for k, value in enumerate(scaled) if value >= 1]
+        self.choices = choices
+        self.prob = [1.0] * n
+        self.alias = list(range(n))
+        while len(small) > 0 and len(large) > 0:
+            less = small.pop()
+            more = large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] += scaled[less] - 1
+            if scaled[more] < 1:
+                small.append(more)
             else:
-                sleep(SLEEP)
+                large.append(more)
+
+    def draw(self, seed, asset_id):
+        # Keyed on the run seed and the asset alone, so a replay gives the same
+        # ticket regardless of page boundaries, ordering or retries
+        digest = hashlib.blake2b(asset_id.to_bytes(8, "big"), key=seed, digest_size=16).digest()
+        column = int.from_bytes(digest[:8], "big") % len(self.choices)
+        if int.from_bytes(digest[8:], "big") / 2 ** 64 < self.prob[column]:
+            return self.choices[column]
+        return self.choices[self.alias[column]]
+
+    def draw_page(self, seed, asset_ids):
+        return [self.draw(seed, asset_id) for asset_id in asset_ids]
+
+def init_state():
+    db = open_state(ENV.get("state", "state.db"))
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS ticket_runs "
+        "(run INTEGER PRIMARY KEY AUTOINCREMENT, collection TEXT NOT NULL, template_id INTEGER NOT NULL, "
+        "seed TEXT NOT NULL, cursor INTEGER NOT NULL, started INTEGER NOT NULL, finished INTEGER)"
+    )
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS ticket_minted "
+        "(run INTEGER NOT NULL, asset_id INTEGER NOT NULL, txn_id TEXT NOT NULL, PRIMARY KEY (run, asset_id))"
+    )
+    # Signed mints the node has not confirmed yet, a resume resends these
+    # exact transactions before it draws anything new
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS ticket_sent "
+        "(run INTEGER NOT NULL, txn_id TEXT NOT NULL, trx TEXT NOT NULL, items TEXT NOT NULL, PRIMARY KEY (run, txn_id))"
+    )
+    db.commit()
+    return db
+
+def load_run(collection, template_id):
+    with STATE_LOCK:
+        return STATE.execute(
+            "SELECT run, seed, cursor FROM ticket_runs WHERE collection = ? AND template_id = ? AND finished IS NULL "
+            "ORDER BY run DESC LIMIT 1",
+            (collection, template_id)
+        ).fetchone()
+
+def start_run(collection, template_id, seed):
+    with STATE_LOCK:
+        run = STATE.execute(
+            "INSERT INTO ticket_runs (collection, template_id, seed, cursor, started) VALUES (?, ?, ?, 0, ?)",
+            (collection, template_id, seed.hex(), int(datetime.now().timestamp()))
+        ).lastrowid
+        STATE.commit()
+    return run
+
+def load_minted(cursor):
+    with STATE_LOCK:
+        rows = STATE.execute("SELECT asset_id FROM ticket_minted WHERE run = ? AND asset_id >= ?", (RUN, cursor)).fetchall()
+    return {asset_id for asset_id, in rows}
+
+def save_sent(txn_id, body, items):
+    asset_ids = [asset_id for asset_id, action in items]
+    with STATE_LOCK:
+        # A mint is only signed again after the node rejected its earlier copy
+        STATE.execute(
+            f"DELETE FROM ticket_sent WHERE run = ? AND txn_id IN (SELECT txn_id FROM ticket_minted "
+            f"WHERE run = ? AND asset_id IN ({','.join('?' * len(asset_ids))}))",
+            (RUN, RUN, *asset_ids)
+        )
+        STATE.executemany(
+            "INSERT OR REPLACE INTO ticket_minted (run, asset_id, txn_id) VALUES (?, ?, ?)",
+            [(RUN, asset_id, txn_id) for asset_id in asset_ids]
+        )
+        STATE.execute(
+            "INSERT OR REPLACE INTO ticket_sent (run, txn_id, trx, items) VALUES (?, ?, ?, ?)",
+            (RUN, txn_id, json.dumps(body), json.dumps(items))
+        )
+        STATE.commit()
+
+def load_sent():
+    with STATE_LOCK:
+        rows = STATE.execute("SELECT txn_id, trx, items FROM ticket_sent WHERE run = ?", (RUN,)).fetchall()
+    return [(txn_id, json.loads(trx), [tuple(item) for item in json.loads(items)]) for txn_id, trx, items in rows]
+
+def confirm_sent(txn_id):
+    with STATE_LOCK:
+        STATE.execute("DELETE FROM ticket_sent WHERE run = ? AND txn_id = ?", (RUN, txn_id))
+        STATE.commit()
+
+def drop_sent(asset_ids):
+    # Never minted, the assets are free to be drawn again
+    with STATE_LOCK:
+        marks = ",".join("?" * len(asset_ids))
+        STATE.execute(
+            f"DELETE FROM ticket_sent WHERE run = ? AND txn_id IN (SELECT txn_id FROM ticket_minted WHERE run = ? AND asset_id IN ({marks}))",
+            (RUN, RUN, *asset_ids)
+        )
+        STATE.execute(f"DELETE FROM ticket_minted WHERE run = ? AND asset_id IN ({marks})", (RUN, *asset_ids))
+        STATE.commit()
+
+def unsettled():
+    with STATE_LOCK:
+        return STATE.execute("SELECT COUNT(*) FROM ticket_sent WHERE run = ?", (RUN,)).fetchone()[0]
+
+def save_cursor(cursor):
+    with STATE_LOCK:
+        STATE.execute("UPDATE ticket_runs SET cursor = ? WHERE run = ?", (cursor, RUN))
+        STATE.commit()
+
+def settle(asset_ids):
+    # The cursor stops at the lowest mint still in flight, everything below
+    # it is settled, so the packer can keep filling batches across pages
+    with CURSOR_LOCK:
+        PENDING.difference_update(asset_ids)
+        save_cursor(min(PENDING) if len(PENDING) > 0 else FRONTIER)
+
+def finish_run():
+    # ticket_log keeps the permanent record, the local rows only serve a resume
+    if unsettled():
+        logger.warning(f"Run {RUN} has unconfirmed mints, resend them with the next run")
+        return
+    with STATE_LOCK:
+        STATE.execute("UPDATE ticket_runs SET finished = ? WHERE run = ?", (int(datetime.now().timestamp()), RUN))
+        STATE.execute("DELETE FROM ticket_minted WHERE run = ?", (RUN,))
+        STATE.commit()
+
+def load_seed(run):
+    with STATE_LOCK:
+        row = STATE.execute("SELECT seed FROM ticket_runs WHERE run = ?", (run,)).fetchone()
+    return None if row is None else bytes.fromhex(row[0])
+
+def seed_used(seed):
+    with STATE_LOCK:
+        return STATE.execute("SELECT 1 FROM ticket_runs WHERE seed = ?", (seed.hex(),)).fetchone() is not None
+
+def eligible(data, block, done):
+    output = []
+    for i in data:
+        if int(i["asset_id"]) in done:
+            continue
+        if i["owner"] == None or int(i["asset_id"]) in SKIP or i["owner"] in block:
+            logger.debug("%s - %s: Skipped", i["owner"], i["asset_id"])
+            continue
+        if "data" in i["mutable_data"] and i["mutable_data"]["data"] != "":
+            recipient = json.loads(i["mutable_data"]["data"])
+            if len(recipient) > 0 and recipient[0]["recipient"] != i["owner"]:
+                logger.debug("%s - %s: Wrong owner, skipped", i["owner"], i["asset_id"])
+                continue
+        output.append(i)
+    return output
+
+def replay(col, tid, seed, block):
+    # Nothing is minted or recorded, the draws go to stdout as JSON lines to
+    # compare against ticket_log, the owners are today's and may have moved
+    count = 0
+    for data in paginate(lambda bound, limit: get_assets(col, tid, bound, limit), fields=ASSET_FIELDS):
+        picks = eligible(data, block, ())
+        for i, choice in zip(picks, sampler.draw_page(seed, [int(i["asset_id"]) for i in picks])):
+            print(json.dumps({
+                "to": i["owner"],
+                "template_id": choice,
+                "asset_id": int(i["asset_id"]),
+                "name": names[choice],
+                "seed": seed.hex()
+            }))
+        count += len(picks)
+    logger.info(f"Replayed {count} draws for seed {seed.hex()}")
 
 def upload_log(data):
-    retry_count = 0
-    while retry_count < RETRY:
-        try:
-            r = requests.post(
-                ENV["supabase_url"] + LOG,
-                headers=HEADERS,
-                json=data,
-                timeout=TIMEOUT
-            )
-            r.raise_for_status()
-            break
-        except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
-            else:
-                sleep(SLEEP)
+    request(
+        "POST",
+        ENV["supabase_url"] + LOG,
+        headers=HEADERS,
+        json=data
+    )
+    count_rows("upsert", len(data))
 
-def transact(actions, api):
-    retry_count = 0
-    trx = {"actions": actions}
-    while True:
+def submit(actions):
+    # The signed body is stored before it leaves, a crash after this point
+    # resends the same transaction instead of drawing the assets again
+    body = chain.packed(chain.build(actions))
+    save_sent(transaction_id(body), body, [(j["asset_id"], j) for j in actions])
+    return chain.send(body, len(actions))
+
+def recover():
+    global status
+    redraw = []
+    for txn_id, body, items in load_sent():
+        asset_ids = [asset_id for asset_id, j in items]
         try:
-            r = api.push_transaction(trx)
-            return r["transaction_id"]
+            # A duplicate means the first copy went through and counts as minted
+            chain.send(body, len(items), resend=True)
         except Exception as err:
-            retry_count += 1
-            if retry_count >= RETRY:
-                raise err
+            if expired(err):
+                # Too late to resend, the history decides whether the first copy landed
+                found = chain.lookup(body)
+                if found:
+                    logger.info(f"Found {txn_id} in history")
+                    minted(txn_id, items)
+                    continue
+                if found is None:
+                    # Kept as minted so the assets are not drawn twice
+                    confirm_sent(txn_id)
+                    msg = f"Transaction {txn_id} expired and the history cannot tell, check {','.join(map(str, asset_ids))} by hand"
+                else:
+                    drop_sent(asset_ids)
+                    redraw.extend(asset_ids)
+                    logger.info(f"Transaction {txn_id} expired without executing, {len(items)} tickets are drawn again")
+                    continue
+            elif rejected(err):
+                drop_sent(asset_ids)
+                msg = f"Minting failed for {','.join(map(str, asset_ids))} - {error_message(err)}"
             else:
-                sleep(SLEEP)
+                msg = f"Resending {txn_id} failed, {str(err)}"
+            logger.exception(msg, exc_info=err)
+            post_alert("fail", NAME, msg)
+            status = 1
+            continue
+        minted(txn_id, items)
+    return redraw
+
+def minted(txn_id, items):
+    confirm_sent(txn_id)
+    settle([asset_id for asset_id, j in items])
+    logger.info(f"Minted {txn_id}: {len(items)} tickets")
+    output = []
+    for asset_id, j in items:
+        tname = names[j["data"]["template_id"]]
+        logger.debug("%s - %s: %s - %s", j["data"]["new_asset_owner"], asset_id, j["data"]["template_id"], tname)
+        output.append({
+            "txn_id": txn_id,
+            "to": j["data"]["new_asset_owner"],
+            "template_id": j["data"]["template_id"],
+            "asset_id": asset_id,
+            "name": tname,
+            "seed": seed.hex()
+        })
+    try:
+        upload_log(output)
+    except Exception as err:
+        msg = f"Failed to upload log for {','.join([str(asset_id) for asset_id, j in items])} - {str(err)}"
+        logger.exception(msg, exc_info=err)
+        post_alert("fail", NAME, msg)
+
+def mint_failed(items, err):
+    global status
+    if rejected(err):
+        drop_sent([asset_id for asset_id, j in items])
+    else:
+        # The node may still have taken it, the next run resends the stored copy
+        status = 1
+    settle([asset_id for asset_id, j in items])
+    msg = f"Minting failed for {','.join([str(asset_id) for asset_id, j in items])} - {error_message(err)}"
+    logger.exception(msg, exc_info=err)
+    post_alert("fail", NAME, msg)
 
 try:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--replay", metavar="SEED", help="print the draws for a logged seed without minting")
+    parser.add_argument("--run", type=int, help="print the draws of a recorded run without minting")
+    args = parser.parse_args()
     logger = setup_logger(NAME)
     try:
-        me = singleton.SingleInstance()
+        me = single_instance(flavor_id="replay" if args.replay or args.run else "")
     except:
         msg = "Already running, exiting"
         logger.error(msg)
         post_alert("fail", NAME, msg)
         exit(1)
 
+    status = 0
     start = datetime.now()
-    with open("config.json") as file:
-        ENV = json.load(file)
+    ENV = load_config()
     with open("skip2.json") as file:
-        SKIP = json.load(file)
+        SKIP = set(json.load(file))
+    configure_http(http2=ENV.get("http2", False))
     HEADERS["apikey"] = ENV["supabase_key"]
     HEADERS["Authorization"] += ENV["supabase_key"]
-    api = EosApi(rpc_host=RPC.format(ENV["rpc"]))
-    api.import_key(ENV["acc"], ENV["acc_key"], "active")
-    api.session.headers["apikey"] = ENV["rpc_key"]
 
     page = 1
     col = ENV["toptix_col"]
     tid = ENV["toptix_tid"]
-    tickets =[i["template_id"] for i in ENV["toptix_choices"]]
-    weights = [i["weight"] for i in ENV["toptix_choices"]]
-    block = get_block()
+    sampler = Sampler([i["template_id"] for i in ENV["toptix_choices"]], [i["weight"] for i in ENV["toptix_choices"]])
+    names = {i["template_id"]: i["name"] for i in ENV["toptix_choices"]}
+    STATE = init_state()
+    if args.replay or args.run:
+        seed = bytes.fromhex(args.replay) if args.replay else load_seed(args.run)
+        if seed is None:
+            logger.error(f"Run {args.run} not found")
+            exit(1)
+        replay(col, tid, seed, {item["collection"] for item in get_block()})
+        exit(0)
+
+    chain = get_chain(ENV)
+    resume = load_run(col, tid)
+    if resume is not None:
+        # An interrupted run continues with its own seed from its last completed page
+        RUN, seed, cursor = resume
+        seed = bytes.fromhex(seed)
+        FRONTIER = cursor
+        redraw = recover()
+        if len(redraw) > 0:
+            # The cursor may have passed them, draw from the lowest again
+            cursor = min(cursor, min(redraw))
+            FRONTIER = cursor
+            save_cursor(cursor)
+        done = load_minted(cursor)
+        logger.info(f"Resuming run {RUN} from {cursor}, {len(done)} assets already minted")
+    else:
+        # A disputed draw is checked with --replay or --run, a live run never
+        # reuses a seed, that would hand every holder the same tickets again
+        seed = bytes.fromhex(ENV["toptix_seed"]) if ENV.get("toptix_seed") else secrets.token_bytes(16)
+        if seed_used(seed):
+            msg = f"Seed {seed.hex()} was already drawn, clear toptix_seed, exiting"
+            logger.error(msg)
+            post_alert("fail", NAME, msg)
+            exit(1)
+        RUN = start_run(col, tid, seed)
+        cursor = 0
+        done = set()
+    logger.info(f"Draw seed {seed.hex()}")
+    block = {item["collection"] for item in get_block()}
+    packer = Packer(
+        submit,
+        minted,
+        mint_failed,
+        size=LIMIT,
+        max_actions=ENV.get("max_actions", MAX_ACTIONS),
+        limits=chain.limits()
+    )
 
+    complete = True
+    FRONTIER = cursor
+    pages = paginate(lambda bound, limit: get_assets(col, tid, bound, limit), fields=ASSET_FIELDS, bound=cursor)
     while True:
         try:
-            data = get_assets(col, tid, page)
-            if len(data) < 1:
+            data = next(pages, None)
+            if data is None:
                 break
         except Exception as err:
             msg = f"{col} - {tid} - {page}: Fetching assets failed, {str(err)}"
             logger.exception(msg, exc_info=err)
             post_alert("fail", NAME, msg)
             status = 1
+            complete = False
             break
 
-        actions = []
-        assets = []
-        for index, i in enumerate(data):
-            bl_check = [item for item in block if item["collection"] == i["owner"]]
-            if i["owner"] == None or int(i["asset_id"]) in SKIP or len(bl_check) > 0:
-                logger.info(f"{i['owner']} - {i['asset_id']}: Skipped")
-                continue
-            if "data" in i["mutable_data"] and i["mutable_data"]["data"] != "":
-                recipient = json.loads(i["mutable_data"]["data"])
-                if len(recipient) > 0 and recipient[0]["recipient"] != i["owner"]:
-                    logger.info(f"{i['owner']} - {i['asset_id']}: Wrong owner, skipped")
-                    continue
-            choice = random.choices(tickets, weights=weights)[0]
+        picks = eligible(data, block, done)
+        draws = sampler.draw_page(seed, [int(i["asset_id"]) for i in picks])
+        for i, choice in zip(picks, draws):
             action = copy.deepcopy(ACTION)
             action["authorization"][0]["actor"] = ENV["acc"]
             action["data"]["authorized_minter"] = ENV["acc"]
@@ -179,47 +440,26 @@ try:
             action["data"]["collection_name"] = ENV["toptix_col"]
             action["data"]["schema_name"] = ENV["toptix_schema"]
             action["data"]["template_id"] = choice
-            actions.append(action)
-            assets.append(int(i["asset_id"]))
-
-            if len(actions) >= LIMIT or index == len(data) - 1:
-                try:
-                    txn_id = transact(actions, api)
-                except Exception as err:
-                    try:
-                        error = json.loads(str(err).replace("transaction error: ", ""))
-                        msg = f"Minting failed for {','.join([str(item) for item in assets])} - {error['error']['details'][0]['message']}"
-                    except:
-                        msg = f"Minting failed for {','.join([str(item) for item in assets])} - {str(err)}"
-                    logger.exception(msg, exc_info=err)
-                    post_alert("fail", NAME, msg)
-                    actions = []
-                    continue
-                logger.info(f"Minted {txn_id}")
-                output = []
-                for ind, j in enumerate(actions):
-                    tname = [i["name"] for i in ENV["toptix_choices"] if i["template_id"] == j["data"]["template_id"]]
-                    logger.info(f"{j['data']['new_asset_owner']} - {assets[ind]}: {j['data']['template_id']} - {tname[0]}")
-                    output.append({
-                        "txn_id": txn_id,
-                        "to": j["data"]["new_asset_owner"],
-                        "template_id": j["data"]["template_id"],
-                        "asset_id": assets[ind],
-                        "name": tname[0]
-                    })
-                try:
-                    upload_log(output)
-                except Exception as err:
-                    msg = f"Failed to upload log for {','.join([item for item in assets])} - {str(err)}"
-                    logger.exception(msg, exc_info=err)
-                    post_alert("fail", NAME, msg)
-                actions = []
-                assets = []
+            # Read back by submit, build() ignores it
+            action["asset_id"] = int(i["asset_id"])
+            with CURSOR_LOCK:
+                PENDING.add(int(i["asset_id"]))
+            packer.add(action, (int(i["asset_id"]), action))
+        FRONTIER = int(data[-1]["asset_id"]) + 1
+        settle(())
         page += 1
+    packer.flush()
+    if complete:
+        finish_run()
 
     end = datetime.now()
     logger.info(end - start)
+    write_metrics(NAME, status)
 except Exception as err:
     msg = f"Main loop failed, {str(err)}"
     logger.exception(msg, exc_info=err)
     post_alert("fail", NAME, msg)
+    write_metrics(NAME, 1)
+finally:
+    if STATE is not None:
+        STATE.close()